@@ -9,58 +9,22 @@ from raspy import *
 f_cur = 'global_actual_biomass_2016_v6_blend_a95_f03_w75_MgCha.tif'
 f_pot = 'global_potential_biomass_v6_blend_MgCha.tif'
 
-cur = raster(f_cur, verbose = True)
-pot = raster(f_pot, verbose = True)
-
-nd = -32768
-
-# -----------------------------------------------------------------
-# match nodata cells in the current and potential layers
-# -----------------------------------------------------------------
-
-cur[np.logical_or(cur == nd, pot == nd)] = nd
-pot[np.logical_or(cur == nd, pot == nd)] = nd
-
-# -----------------------------------------------------------------
-# cap outliers
-# -----------------------------------------------------------------
-
-# cap both current and potential biomass outliers to the global
-# 99.99th percentile of potential biomass
-
-pot_pct = np.percentile(pot[pot > 0], 99.99)
-
-cur[cur > pot_pct] = pot_pct
-pot[pot > pot_pct] = pot_pct
-
-# -----------------------------------------------------------------
-# adjust potential
-# -----------------------------------------------------------------
-
-# if current > potential, then set potential to current
-# there is no unrealized potential C in these places
-
-pot[cur > pot] = cur[cur > pot]
-
-# -----------------------------------------------------------------
-# mask water
-# -----------------------------------------------------------------
-
 # igbp land/water probability (0-75 = prob water; 76-100 = prob land; 255 = fill)
-lwp = raster('water_prob.tif')
+f_lwp = 'water_prob.tif'
+cache_layer(f_lwp, verbose = True)
 
-cur[cur == nd] = 0
-pot[pot == nd] = 0
-
-cur[np.logical_or(lwp <= 75, lwp == 255)] = nd
-pot[np.logical_or(lwp <= 75, lwp == 255)] = nd
+nd = -32768
 
 # -----------------------------------------------------------------
-# outputs
+# harmonize current and potential
 # -----------------------------------------------------------------
 
-gt, sr = get_gt_sr(f_cur)
-write_gtiff(cur, 'Base_Cur_AGB_MgCha_500m.tif', dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
+# in one block-streamed pass (plus one pass for the percentile):
+# - match nodata cells in the current and potential layers
+# - cap both current and potential biomass outliers to the global
+#   99.99th percentile of potential biomass
+# - if current > potential, then set potential to current
+#   (there is no unrealized potential C in these places)
+# - set nodata cells to 0 and mask water
 
-gt, sr = get_gt_sr(f_pot)
-write_gtiff(pot, 'Base_Pot_AGB_MgCha_500m.tif', dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
+harmonize(f_cur, f_pot, f_lwp, 'Base_Cur_AGB_MgCha_500m.tif', 'Base_Pot_AGB_MgCha_500m.tif', nd_in = nd, nd_out = nd, cap_pct = 99.99, workers = os.cpu_count(), msg = True)
@@ -14,89 +14,88 @@ f_cur_upr = 'global_actual_v5_quant_reg_q97_5_MgCha.tif'
 f_pot_lwr = 'global_potential_v5_quant_reg_q2_5_MgCha.tif'
 f_pot_upr = 'global_potential_v5_quant_reg_q97_5_MgCha.tif'
 
-cur = raster(f_cur, verbose = True)
-cur_lwr = raster(f_cur_lwr, verbose = True)
-cur_upr = raster(f_cur_upr, verbose = True)
-
-pot = raster(f_pot, verbose = True)
-pot_lwr = raster(f_pot_lwr, verbose = True)
-pot_upr = raster(f_pot_upr, verbose = True)
+inputs = {'cur': f_cur, 'cur_lwr': f_cur_lwr, 'cur_upr': f_cur_upr,
+	'pot': f_pot, 'pot_lwr': f_pot_lwr, 'pot_upr': f_pot_upr}
 
 nd = -32768
 
+# all layers are streamed block-by-block (two reads per input), so
+# peak memory is bounded by the window size rather than the globe
+
+workers = os.cpu_count()
+
 # -----------------------------------------------------------------
 # match nodata/water cells
 # -----------------------------------------------------------------
 
-ind = np.logical_or.reduce((cur == nd, cur_lwr == nd, cur_upr == nd, pot_lwr == nd, pot_upr == nd)) # cur and pot have same nodata/water cells
-
-cur_lwr[ind] = nd
-cur_upr[ind] = nd
-
-pot_lwr[ind] = nd
-pot_upr[ind] = nd
+def nodata_mask(blk):
+	# cur and pot have same nodata/water cells
+	return np.logical_or.reduce((blk['cur'] == nd, blk['cur_lwr'] == nd, blk['cur_upr'] == nd, blk['pot_lwr'] == nd, blk['pot_upr'] == nd))
 
 # -----------------------------------------------------------------
-# cap outliers
+# pass 1: percentiles for capping outliers
 # -----------------------------------------------------------------
 
-# lower limit layers
-lwr_pot_pct = np.percentile(pot_lwr[pot_lwr > 0], 99.99)
-cur_lwr[cur_lwr > lwr_pot_pct] = lwr_pot_pct
-pot_lwr[pot_lwr > lwr_pot_pct] = lwr_pot_pct
-
-# upper limit layers
-upr_pot_pct = np.percentile(pot_upr[pot_upr > 0], 99.99)
-cur_upr[cur_upr > upr_pot_pct] = upr_pot_pct
-pot_upr[pot_upr > upr_pot_pct] = upr_pot_pct
+def pct_stats(blk):
+	vld = ~nodata_mask(blk)
+	metrics = {}
+	for name in ['pot_lwr', 'pot_upr']:
+		arr = blk[name]
+		metrics[name] = RunningStats(hist = True)
+		metrics[name].update(arr[vld & (arr > 0)])
+	return {}, metrics
 
-# -----------------------------------------------------------------
-# adjust potential
-# -----------------------------------------------------------------
+metrics = run_parallel(pct_stats, inputs, outputs = {}, workers = workers, msg = True)
 
-# lower limit layers
-pot_lwr[cur_lwr > pot_lwr] = cur_lwr[cur_lwr > pot_lwr]
+# 99.99th percentiles of the lower and upper limit potential layers (exact, as np.percentile)
+lwr_pot_pct = metrics['pot_lwr'].quantile(0.9999)
+upr_pot_pct = metrics['pot_upr'].quantile(0.9999)
 
-# upper limit layers
-pot_upr[cur_upr > pot_upr] = cur_upr[cur_upr > pot_upr]
+print('Lower limit cap: {}; upper limit cap: {}'.format(lwr_pot_pct, upr_pot_pct), flush = True)
 
 # -----------------------------------------------------------------
-# compute uncertainty index
+# pass 2: cap outliers, adjust potential and compute uncertainty index
 # -----------------------------------------------------------------
 
-def unc_ind(bio, lwr, upr):
-	
-	# index valid data cells
-	vld = np.logical_and.reduce((bio != nd, lwr != nd, upr != nd))
-	
-	# save memory
-	vbio = bio[vld]; del bio
-	vlwr = lwr[vld]; del lwr
-	vupr = upr[vld]; del upr
+def cap(arr, pct):
+	return np.where(arr > pct, np.array(pct).astype(arr.dtype), arr)
+
+def unc_ind(bio, lwr, upr, vld):
 	
 	# initialize output array
 	unc = np.full(vld.shape, dtype = np.int16, fill_value = nd)
 	
-	# compute numerator for uncertainty index
-	vnum = vupr - vlwr
-	del vupr, vlwr
-	
 	# divide by bio and convert from float to integer,
 	# supress/hide the warnings issued by zero division
+	# and set division by zero results to 0 before casting
 	with np.errstate(all = 'ignore'):
-		unc[vld] = np.rint(np.true_divide(vnum, vbio)).astype(np.int16)
-	del vnum, vbio, vld
-	unc[np.logical_or(np.isinf(unc), np.isnan(unc))] = 0
+		vunc = np.rint(np.true_divide(upr[vld] - lwr[vld], bio[vld]))
+	vunc[~np.isfinite(vunc)] = 0
+	unc[vld] = vunc.astype(np.int16)
 	return unc
 
-cur_unc = unc_ind(bio = cur, lwr = cur_lwr, upr = cur_upr)
-pot_unc = unc_ind(bio = pot, lwr = pot_lwr, upr = pot_upr)
+def unc_block(blk):
+	ind = nodata_mask(blk)
+	
+	# cap outliers
+	cur_lwr = cap(blk['cur_lwr'], lwr_pot_pct)
+	pot_lwr = cap(blk['pot_lwr'], lwr_pot_pct)
+	cur_upr = cap(blk['cur_upr'], upr_pot_pct)
+	pot_upr = cap(blk['pot_upr'], upr_pot_pct)
+	
+	# adjust potential
+	pot_lwr = np.maximum(pot_lwr, cur_lwr)
+	pot_upr = np.maximum(pot_upr, cur_upr)
+	
+	cur_unc = unc_ind(bio = blk['cur'], lwr = cur_lwr, upr = cur_upr, vld = ~ind)
+	pot_unc = unc_ind(bio = blk['pot'], lwr = pot_lwr, upr = pot_upr, vld = ~ind & (blk['pot'] != nd))
+	return {'cur_unc': cur_unc, 'pot_unc': pot_unc}
 
 # -----------------------------------------------------------------
 # outputs
 # -----------------------------------------------------------------
 
-gt, sr = get_gt_sr(f_cur)
+outputs = {'cur_unc': {'file': 'Base_Cur_UI_500m.tif', 'dtype': 'Int16', 'nodata': nd},
+	'pot_unc': {'file': 'Base_Pot_UI_500m.tif', 'dtype': 'Int16', 'nodata': nd}}
 
-write_gtiff(cur_unc, 'Base_Cur_UI_500m.tif', dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
-write_gtiff(pot_unc, 'Base_Pot_UI_500m.tif', dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
+run_parallel(unc_block, inputs, outputs, workers = workers, stats = True, msg = True)
@@ -1,85 +1,98 @@
 #!/usr/bin/env python3
 
 import pandas as pd
-from progressbar import *
 from raspy import *
 
 # current aboveground biomass density (Mg/ha)
 f_cur = 'Base_Cur_AGB_Mgha_500m.tif'
-agb = raster(f_cur, verbose = True)
 agb_nd = get_nodata(f_cur)
-agb[agb == agb_nd] = 0
 
 # rasterized Dinerstein et al. ecoregions
-ecos = raster('ecoregions_500m.tif', verbose = True)
+f_ecos = 'ecoregions_500m.tif'
 eco_df = pd.read_csv('eco_r2s_ratios.csv')
 
 # rasterized Dinerstein et al. biomes
-biomes = raster('biomes_500m.tif', verbose = True)
-
-# initialize root:shoot array
-r2s_flt = np.full(agb.shape, fill_value = 0, dtype = np.float32)
-
-print('1. Boreal forests or taiga ...', flush = True)
-r2s_flt[(biomes == 6) & (agb <= 75)] = 0.392
-r2s_flt[(biomes == 6) & (agb  > 75)] = 0.239
-
-print('2. Mangroves ...', flush = True)
-r2s_flt[biomes == 14] = 0.39 # from Hutchison et al. 2014
-
-print('3. Mediterranean forests, woodlands, and scrub ...', flush = True)
-r2s_flt[biomes == 12] = 0.371
-
-print('4. Temperate broadleaf and mixed forests ...', flush = True)
-widgets = [FormatLabel('Processing'), Bar(marker = '.', left = ' ', right = '', fill =' '), ' ', Percentage(), ' | ', ETA(), '    ']
-pbar = ProgressBar(widgets = widgets).start()
-nrows = len(eco_df.index)
-for index, row in eco_df.iterrows():
-	if row['biome_code'] == 4:
-		eco_code = row['eco_code']
-		mokany_biome = row['mokany_biome']
-		# mokany temperate oak forest
-		if mokany_biome == 'tof':
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb > 70)] = 0.295
-		# mokany temperate eucalypt forest/plantation
-		if mokany_biome == 'tef':
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb < 50)] = 0.437
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb >= 50) & (agb <= 150)] = 0.275
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb > 150)] = 0.2
-		# mokany other temperate broadleaf forest/plantation
-		if mokany_biome == 'otbf':
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb < 75)] = 0.456
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb >= 75) & (agb <= 150)] = 0.226
-			r2s_flt[(biomes == 4) & (ecos == eco_code) & (agb > 150)] = 0.241
-	pbar.update((index+1)/nrows*100)
-pbar.finish()
-del ecos
-
-print('5. Temperate conifer forests ...', flush = True)
-r2s_flt[(biomes == 5) & (agb < 50)] = 0.403
-r2s_flt[(biomes == 5) & (agb >= 50) & (agb <= 150)] = 0.292
-r2s_flt[(biomes == 5) & (agb > 150)] = 0.201
-
-print('6. Tropical and subtropical coniferous forests ...', flush = True)
-r2s_flt[(biomes == 3) & (agb < 50)] = 0.403
-r2s_flt[(biomes == 3) & (agb >= 50) & (agb <= 150)] = 0.292
-r2s_flt[(biomes == 3) & (agb > 150)] = 0.201
-
-print('7. Tropical and subtropical dry broadleaf forests ...', flush = True)
-r2s_flt[(biomes == 2) & (agb <= 20)] = 0.563
-r2s_flt[(biomes == 2) & (agb  > 20)] = 0.275
-
-print('8. Tropical and subtropical moist broadleaf forests ...', flush = True)
-r2s_flt[(biomes == 1) & (agb <= 125)] = 0.205
-r2s_flt[(biomes == 1) & (agb  > 125)] = 0.235
-
-# free mem
-del agb
-del biomes
+f_biomes = 'biomes_500m.tif'
+
+# -----------------------------------------------------------------
+# rule table
+# -----------------------------------------------------------------
+
+# each rule is a list of agb breakpoints and the root:shoot ratio of every
+# agb position relative to them: below the first breakpoint, equal to it,
+# between the first and second breakpoints, equal to the second, ..., above
+# the last breakpoint (None = no ratio assigned)
+
+# biome-level rules
+biome_rules = collections.OrderedDict([
+	(6, ('Boreal forests or taiga', [75], [0.392, 0.392, 0.239])),
+	(14, ('Mangroves', [], [0.39])), # from Hutchison et al. 2014
+	(12, ('Mediterranean forests, woodlands, and scrub', [], [0.371])),
+	(5, ('Temperate conifer forests', [50, 150], [0.403, 0.292, 0.292, 0.292, 0.201])),
+	(3, ('Tropical and subtropical coniferous forests', [50, 150], [0.403, 0.292, 0.292, 0.292, 0.201])),
+	(2, ('Tropical and subtropical dry broadleaf forests', [20], [0.563, 0.563, 0.275])),
+	(1, ('Tropical and subtropical moist broadleaf forests', [125], [0.205, 0.205, 0.235]))
+])
+
+# temperate broadleaf and mixed forests (biome 4) are split by ecoregion into mokany classes
+mokany_rules = collections.OrderedDict([
+	('tof', ('Mokany temperate oak forest', [70], [None, None, 0.295])),
+	('tef', ('Mokany temperate eucalypt forest/plantation', [50, 150], [0.437, 0.275, 0.275, 0.275, 0.2])),
+	('otbf', ('Mokany other temperate broadleaf forest/plantation', [75, 150], [0.456, 0.226, 0.226, 0.226, 0.241]))
+])
+
+# rule ids (0 = no rule)
+rules = [None] + list(biome_rules.values()) + list(mokany_rules.values())
 
 # apply scaling factor to ratios to save as integer on disk to save space
-r2s_int = np.rint(r2s_flt*1e3).astype(np.int16)
-del r2s_flt
-
-gt, sr = get_gt_sr(f_cur)
-write_gtiff(r2s_int, 'Root2Shoot_Ratios_Scaled1e3_500m.tif', dtype = 'UInt16', nodata = 0, gt = gt, sr = sr, stats = True, msg = True)
+# (in float32, as the ratios were originally stored); unassigned positions are 0
+def scaled_ratios(ratios):
+	flt = np.array([0 if r == None else r for r in ratios], dtype = np.float32)
+	return np.rint(flt * 1e3).astype(np.uint16)
+
+rule_breaks = [None] + [np.array(r[1]) for r in rules[1:]]
+rule_ratios = [None] + [scaled_ratios(r[2]) for r in rules[1:]]
+
+# biome code -> rule id
+biome_lut = np.zeros(max(biome_rules) + 1, dtype = np.uint8)
+for i, b in enumerate(biome_rules): biome_lut[b] = 1 + i
+
+# temperate broadleaf ecoregion code -> rule id
+eco_tbf = eco_df[eco_df['biome_code'] == 4]
+eco_lut = np.zeros(eco_tbf['eco_code'].max() + 1, dtype = np.uint8)
+for eco_code, mokany_biome in zip(eco_tbf['eco_code'], eco_tbf['mokany_biome']):
+	eco_lut[eco_code] = 1 + len(biome_rules) + list(mokany_rules).index(mokany_biome)
+
+# -----------------------------------------------------------------
+# assign ratios
+# -----------------------------------------------------------------
+
+def lookup(lut, codes):
+	# codes outside the lut get rule 0
+	ids = np.zeros(codes.shape, dtype = lut.dtype)
+	ind = (codes >= 0) & (codes < lut.size)
+	ids[ind] = lut[codes[ind]]
+	return ids
+
+def agb_position(agb, breaks):
+	# 2i for agb between breaks i-1 and i, 2i+1 for agb equal to break i
+	i = np.digitize(agb, breaks, right = True)
+	pos = 2 * i
+	ind = i < breaks.size
+	pos[ind] += (agb[ind] == breaks[i[ind]])
+	return pos
+
+def r2s_block(blk):
+	agb = np.where(blk['agb'] == agb_nd, 0, blk['agb'])
+	biomes = blk['biomes']
+	rule = np.where(biomes == 4, lookup(eco_lut, blk['ecos']), lookup(biome_lut, biomes))
+	r2s = np.zeros(agb.shape, dtype = np.uint16)
+	for r in range(1, len(rules)):
+		ind = rule == r
+		if not ind.any(): continue
+		r2s[ind] = rule_ratios[r][agb_position(agb[ind], rule_breaks[r])]
+	return r2s
+
+inputs = {'agb': f_cur, 'ecos': f_ecos, 'biomes': f_biomes}
+outputs = {'r2s': {'file': 'Root2Shoot_Ratios_Scaled1e3_500m.tif', 'dtype': 'UInt16', 'nodata': 0}}
+run_parallel(r2s_block, inputs, outputs, workers = os.cpu_count(), stats = True, msg = True)
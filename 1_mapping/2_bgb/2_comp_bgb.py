@@ -4,33 +4,53 @@ from raspy import *
 
 # root:shoot ratios
 f_r2s = 'Root2Shoot_Ratios_Scaled1e3_500m.tif'
-r2s = raster(f_r2s, verbose = True)
 
-# apply scaling factor
+# scaling factor applied to ratios on disk
 scale_factor = 1000
-r2s = r2s / scale_factor
 
-def comp_bgb(r2s, f_agb, f_bgb):
+def comp_bgb(f_agb, f_bgb):
 	
-	agb = raster(f_agb, verbose = True)
 	nd = get_nodata(f_agb)
-	gt, sr = get_gt_sr(f_agb)
-	
-	# multiply aboveground by root:shoot ratios
-	bgb_flt = agb * r2s
 	
+	# multiply aboveground by root:shoot ratios, and
 	# apply mokany et al.'s (2006) eq. 1 to pixels with no r:s ratio
-	eq1_ind = (agb != nd) & (agb > 0) & (r2s == 0)
-	bgb_flt[eq1_ind] = np.power(agb[eq1_ind], 0.89) * 0.489
-	del eq1_ind
+	expr = 'np.rint(np.where((agb > 0) & (r2s == 0), np.power(agb, 0.89) * 0.489, agb * (r2s / {})))'.format(scale_factor)
+	
+	calc(expr, inputs = {'agb': f_agb, 'r2s': f_r2s}, out_tif = f_bgb, dtype = 'Int16', nodata = nd, mask = {'agb': nd}, workers = os.cpu_count(), stats = True, msg = True)
+	return
+
+def bgb_block(blk, nd):
+	
+	# float32 root:shoot ratios of the window, shared by all scenarios
+	r2s = blk['r2s'].astype(np.float32) / np.float32(scale_factor)
+	no_r2s = r2s == 0
 	
-	bgb_int = np.rint(bgb_flt).astype(np.int16)
-	del bgb_flt
+	res = {}
+	for name, agb_nd in nd.items():
+		agb = blk[name]
+		agb_flt = agb.astype(np.float32)
+		# multiply aboveground by root:shoot ratios, and
+		# apply mokany et al.'s (2006) eq. 1 to pixels with no r:s ratio
+		with np.errstate(all = 'ignore'):
+			bgb = np.rint(np.where((agb > 0) & no_r2s, np.power(agb_flt, np.float32(0.89)) * np.float32(0.489), agb_flt * r2s)).astype(np.int16)
+		bgb[agb == agb_nd] = agb_nd
+		res[name] = bgb
+	return res
+
+def comp_bgb_batch(f_agb_lst, workers = None):
 	
-	bgb_int[agb == nd] = nd
-	del agb
+	# read each window of the ratios once and apply it to every scenario,
+	# writing all belowground outputs concurrently
+	inputs = {'r2s': f_r2s}
+	outputs = {}
+	nd = {}
+	for i, f_agb in enumerate(f_agb_lst):
+		name = 'agb{}'.format(i)
+		nd[name] = get_nodata(f_agb)
+		inputs[name] = f_agb
+		outputs[name] = {'file': f_agb.replace('AGB', 'BGB'), 'dtype': 'Int16', 'nodata': nd[name]}
 	
-	write_gtiff(bgb_int, f_bgb, dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
+	run_parallel(functools.partial(bgb_block, nd = nd), inputs, outputs, workers = workers, stats = True, msg = True)
 	return
 
 def main():
@@ -53,10 +73,8 @@ def main():
 		'RCP85y50mean_Pot_AGB_MgCha_500m.tif'
 	]
 	
-	# compute belowground
-	for f_agb in f_agb_lst:
-		f_bgb = f_agb.replace('AGB', 'BGB')
-		comp_bgb(r2s, f_agb, f_bgb)
+	# compute belowground for all scenarios in one pass over the ratios
+	comp_bgb_batch(f_agb_lst, workers = os.cpu_count())
 
 if __name__ == '__main__':
 	main()
@@ -1,26 +1,26 @@
 #!/usr/bin/env python3
 
+import argparse
 from raspy import *
 
-def comp_unr(f_cur_i, f_pot_i, f_unr_o, nd = -32768, verbose = True):
-	cur = raster(f_cur_i, verbose = verbose)
-	pot = raster(f_pot_i, verbose = verbose)
-	ind = np.logical_or(cur == nd, pot == nd)
-	cur[ind] = 0
-	pot[ind] = 0
-	unr = pot - cur
-	unr[ind] = nd
-	gt, sr = get_gt_sr(f_cur_i)
-	write_gtiff(unr, f_unr_o, dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = verbose)
+def argparse_init():
+	p = argparse.ArgumentParser(description = 'Compute baseline unrealized potential carbon (potential - current).', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+	p.add_argument('--virtual', help = 'write small virtual layer specs (evaluated on the fly by raspy readers, see raspy.materialize()) instead of GeoTIFFs', action = 'store_true')
+	return p
+
+def comp_unr(f_cur_i, f_pot_i, f_unr_o, nd = -32768, virtual = False, verbose = True):
+	calc('pot - cur', inputs = {'cur': f_cur_i, 'pot': f_pot_i}, out_tif = f_unr_o, dtype = 'Int16', nodata = nd, mask = {'cur': nd, 'pot': nd}, workers = os.cpu_count(), stats = True, virtual = virtual, msg = verbose)
 	return
 
 def main():
+	args = argparse_init().parse_args()
 	pools = ['AGB', 'BGB', 'SOC']
 	for pool in pools:
 		comp_unr(
 			f_cur_i = 'Base_Cur_{}_MgCha_500m.tif'.format(pool), 
 			f_pot_i = 'Base_Pot_{}_MgCha_500m.tif'.format(pool), 
-			f_unr_o = 'Base_Unr_{}_MgCha_500m.tif'.format(pool)
+			f_unr_o = 'Base_Unr_{}_MgCha_500m.tif'.format(pool),
+			virtual = args.virtual
 		)
 
 if __name__ == '__main__':
@@ -3,21 +3,68 @@
 from raspy import *
 
 nd = -32768
+nd_agree = 255
 pools = ['AGB', 'BGB']
-mdls = ['bc', 'cc', 'gs', 'hd', 'he', 'ip', 'mc', 'mg', 'mi', 'mr', 'no', 'mean'] # 11 earth system models and pixel-based mean
+gcms = ['bc', 'cc', 'gs', 'hd', 'he', 'ip', 'mc', 'mg', 'mi', 'mr', 'no'] # 11 earth system models
+mdls = gcms + ['mean'] # and pixel-based mean
+ens_stats = ['mean', 'min', 'max', 'std']
 
-for pool in pools:
-	cur = raster('Base_Cur_{}_MgCha_500m.tif'.format(pool), verbose = True)
-	for mdl in mdls:
-		
-		f_pot = 'RCP85y50{}_Pot_{}_MgCha_500m.tif'.format(mdl, pool)
-		pot = raster(f_pot, verbose = True)
+def unr_block(blk):
+	
+	cur = blk['cur']
+	res = {}
 	
-		ind = np.logical_or(cur == nd, pot == nd)
-		cur[ind] = 0
-		pot[ind] = 0
+	# unrealized potential of each model, without modifying the shared current layer
+	for mdl in mdls:
+		pot = blk[mdl]
+		ind = (cur == nd) | (pot == nd)
 		unr = pot - cur
 		unr[ind] = nd
-		
-		gt, sr = get_gt_sr(f_pot)
-		write_gtiff(unr, 'RCP85y50{}_Unr_{}_MgCha_500m.tif'.format(mdl, pool), dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
+		res[mdl] = unr
+	
+	# per-pixel ensemble statistics over the valid gcms
+	unr = np.stack([res[mdl] for mdl in gcms]).astype(np.float64)
+	vld = unr != nd
+	cnt = vld.sum(axis = 0)
+	ind = cnt == 0
+	with np.errstate(all = 'ignore'):
+		mean = np.where(vld, unr, 0).sum(axis = 0) / cnt
+		std = np.sqrt(np.where(vld, np.square(unr - mean), 0).sum(axis = 0) / cnt)
+	ens = {
+		'mean': mean,
+		'min': np.where(vld, unr, np.inf).min(axis = 0),
+		'max': np.where(vld, unr, -np.inf).max(axis = 0),
+		'std': std
+	}
+	for stat, arr in ens.items():
+		arr = np.rint(np.where(ind, 0, arr)).astype(np.int16)
+		arr[ind] = nd
+		res['ens' + stat] = arr
+	
+	# agreement: number of gcms with unrealized potential (> 0)
+	agree = ((unr > 0) & vld).sum(axis = 0).astype(np.uint8)
+	agree[ind] = nd_agree
+	res['ensagree'] = agree
+	return res
+
+def comp_unr_ens(pool, workers = None, verbose = True):
+	
+	# read each window of the current layer once and stream all model potentials side by side
+	inputs = {'cur': 'Base_Cur_{}_MgCha_500m.tif'.format(pool)}
+	outputs = {}
+	for mdl in mdls:
+		inputs[mdl] = 'RCP85y50{}_Pot_{}_MgCha_500m.tif'.format(mdl, pool)
+		outputs[mdl] = {'file': 'RCP85y50{}_Unr_{}_MgCha_500m.tif'.format(mdl, pool), 'dtype': 'Int16', 'nodata': nd}
+	for stat in ens_stats:
+		outputs['ens' + stat] = {'file': 'RCP85y50ens{}_Unr_{}_MgCha_500m.tif'.format(stat, pool), 'dtype': 'Int16', 'nodata': nd}
+	outputs['ensagree'] = {'file': 'RCP85y50ensagree_Unr_{}_500m.tif'.format(pool), 'dtype': 'Byte', 'nodata': nd_agree}
+	
+	run_parallel(unr_block, inputs, outputs, workers = workers, stats = True, msg = verbose)
+	return
+
+def main():
+	for pool in pools:
+		comp_unr_ens(pool, workers = os.cpu_count())
+
+if __name__ == '__main__':
+	main()
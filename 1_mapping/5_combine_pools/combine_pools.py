@@ -1,31 +1,69 @@
 #!/usr/bin/env python3
 
+import argparse
 from raspy import *
 
+p = argparse.ArgumentParser(description = 'Combine AGB, BGB and SOC carbon pools.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+p.add_argument('--virtual', help = 'write small virtual layer specs (evaluated on the fly by raspy readers, see raspy.materialize()) instead of GeoTIFFs', action = 'store_true')
+args = p.parse_args()
+
 nd = -32768
 
-for store in ['Cur', 'Pot', 'Unr']:
-	
-	f_agb = 'Base_{}_AGB_MgCha_500m.tif'.format(store)
-	agb = raster(f_agb, verbose = True)
-	gt, sr = get_gt_sr(f_agb)
-	
-	bgb = raster('Base_{}_BGB_MgCha_500m.tif'.format(store), verbose = True)
-	soc = raster('Base_{}_SOC_MgCha_500m.tif'.format(store), verbose = True)
-	
-	ind = np.logical_or.reduce((agb == nd, bgb == nd, soc == nd))
-	agb[ind] = 0
-	bgb[ind] = 0
-	soc[ind] = 0
-	
-	# AGB+BGB only
-	bio = agb + bgb
-	bio[ind] = nd
-	write_gtiff(bio, 'Base_{}_AGB_BGB_MgCha_500m.tif'.format(store), dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
-	del bio
+# sums are accumulated in int32 and saturated to the valid Int16 range
+# (nd is reserved for nodata) instead of silently wrapping around
+c_min = -32767
+c_max = 32767
+
+stores = ['Cur', 'Pot', 'Unr']
+combos = {'AGB_BGB': ['agb', 'bgb'], 'AGB_BGB_SOC': ['agb', 'bgb', 'soc']}
+
+inputs = {}
+outputs = {}
+for store in stores:
+	for pool in ['agb', 'bgb', 'soc']:
+		inputs[store + '_' + pool] = 'Base_{}_{}_MgCha_500m.tif'.format(store, pool.upper())
+	for combo in combos:
+		outputs[store + '_' + combo] = {'file': 'Base_{}_{}_MgCha_500m.tif'.format(store, combo), 'dtype': 'Int16', 'nodata': nd}
+
+# -----------------------------------------------------------------
+# combine pools
+# -----------------------------------------------------------------
+
+def saturate(tot, ind):
+	# clip int32 sums to the Int16 range, and count the valid cells that were clipped
+	n_sat = int(np.count_nonzero(((tot < c_min) | (tot > c_max)) & ~ind))
+	out = np.clip(tot, c_min, c_max).astype(np.int16)
+	out[ind] = nd
+	return out, n_sat
+
+def combine_block(blk):
+	res = {}
+	metrics = {}
+	for store in stores:
+		agb, bgb, soc = [blk[store + '_' + pool] for pool in ['agb', 'bgb', 'soc']]
+		
+		# nodata in any pool is nodata in the combined layers
+		ind = np.logical_or.reduce((agb == nd, bgb == nd, soc == nd))
+		
+		# AGB+BGB only
+		tot = agb.astype(np.int32) + bgb
+		res[store + '_AGB_BGB'], metrics[store + '_AGB_BGB'] = saturate(tot, ind)
+		
+		# AGB+BGB+SOC
+		tot += soc
+		res[store + '_AGB_BGB_SOC'], metrics[store + '_AGB_BGB_SOC'] = saturate(tot, ind)
+	return res, metrics
+
+if args.virtual:
+	# the same sums as small virtual layer specs, evaluated on the fly by readers
+	for store in stores:
+		for combo, pools in combos.items():
+			expr = 'np.clip({}, {}, {})'.format(' + '.join(pools), c_min, c_max)
+			calc(expr, inputs = {pool: inputs[store + '_' + pool] for pool in ['agb', 'bgb', 'soc']}, out_tif = outputs[store + '_' + combo]['file'], dtype = 'Int16', nodata = nd, mask = {'agb': nd, 'bgb': nd, 'soc': nd}, work_dtype = np.int32, virtual = True, msg = True)
+else:
+	# each block of the nine inputs is read once and all six outputs are written in the same pass
+	metrics = run_parallel(combine_block, inputs, outputs, workers = os.cpu_count(), stats = True, msg = True)
 	
-	# AGB+BGB+SOC
-	tot = agb + bgb + soc
-	tot[ind] = nd
-	write_gtiff(tot, 'Base_{}_AGB_BGB_SOC_MgCha_500m.tif'.format(store), dtype = 'Int16', gt = gt, sr = sr, nodata = nd, stats = True, msg = True)
-	del tot
+	# number of valid cells saturated at the Int16 range, per output
+	for name, n_sat in metrics.items():
+		print('{}: {} saturated cells'.format(name, n_sat), flush = True)
@@ -7,20 +7,32 @@ import pandas as pd
 #  0 = not cropland (nodata)
 #  1 = cropland (not shifting ag)
 #  2 = cropland (shifting ag)
-crop = raster('gfsad_crop_mask_500m_with_shift_ag.tif', verbose = True)
+f_crop = 'gfsad_crop_mask_500m_with_shift_ag.tif'
 
 # pasture (0 = not pasture/nodata, 1 = pasture)
-past = raster('ramankutty_pasture_mask_500m.tif', verbose = True)
+f_past = 'ramankutty_pasture_mask_500m.tif'
 
 # urban (0 = not urban/nodata, 1 = urban)
-urbn = raster('ghsl_urban_mask_500m.tif', verbose = True)
-
-# combine constraints into one mutually exclusive layer (note order matters for giving priority)
-cons = np.zeros(crop.shape, np.uint8)
-cons[urbn == 1] = 4 # urban
-cons[past == 1] = 3 # pasture
-cons[crop == 2] = 2 # cropland (shifting ag)
-cons[crop == 1] = 1 # cropland (not shifting ag)
+f_urbn = 'ghsl_urban_mask_500m.tif'
+
+# pack the constraint masks as bit planes of one small Byte raster (one pass over the inputs):
+#  bit 0 = cropland (not shifting ag)
+#  bit 1 = cropland (shifting ag)
+#  bit 2 = pasture
+#  bit 3 = urban
+planes = collections.OrderedDict([
+	('crop', 'crop == 1'),
+	('shift', 'crop == 2'),
+	('past', 'past == 1'),
+	('urbn', 'urbn == 1')
+])
+f_masks = 'Societal_Constraints_Masks_500m.tif'
+pack_masks({'crop': f_crop, 'past': f_past, 'urbn': f_urbn}, planes, f_masks, workers = os.cpu_count(), msg = True)
+
+# combine constraints into one mutually exclusive layer, reading only the packed masks
+# (note order matters for giving priority: the first plane set wins)
+expr = 'np.select([{}], [1, 2, 3, 4], 0)'.format(', '.join('(m & {}) != 0'.format(plane_bits(list(planes), [name])) for name in planes))
+calc(expr, inputs = {'m': f_masks}, out_tif = 'Societal_Constraints_500m.tif', dtype = 'Byte', nodata = 0, mask = [], workers = os.cpu_count(), stats = True, msg = True)
 
 # therefore:
 #  0 = no constraint (nodata)
@@ -29,9 +41,6 @@ cons[crop == 1] = 1 # cropland (not shifting ag)
 #  3 = pasture
 #  4 = urban
 
-gt, sr = get_gt_sr('gfsad_crop_mask_500m_with_shift_ag.tif')
-write_gtiff(cons, out_tif = 'Societal_Constraints_500m.tif', dtype = 'Byte', gt = gt, sr = sr, nodata = 0, msg = True, stats = True)
-
 dct = {'cons_code': [1, 2, 3, 4], 'cons_name': ['cropland (not shifting ag)', 'cropland (shifting ag)', 'pasture', 'urban']}
 df = pd.DataFrame.from_dict(dct)
 df.to_csv('constraints.csv', index = False)
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import argparse
 from raspy import *
 
+p = argparse.ArgumentParser(description = 'Mask unrealized potential carbon with societal constraints.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+p.add_argument('--virtual', help = 'write small virtual layer specs (evaluated on the fly by raspy readers, see raspy.materialize()) instead of GeoTIFFs', action = 'store_true')
+p.add_argument('--sweep', help = 'also write the constraint subset scenarios (see scenarios) in the same pass', action = 'store_true')
+args = p.parse_args()
+
 f_cons = 'Societal_Constraints_500m.tif'
-cons = raster(f_cons, verbose = True)
-gt, sr = get_gt_sr(f_cons)
 
 #  0 = no constraint (nodata)
 #  1 = cropland (not shifting ag)
@@ -12,7 +16,38 @@ gt, sr = get_gt_sr(f_cons)
 #  3 = pasture
 #  4 = urban
 
-for pool in ['AGB', 'BGB', 'AGB_BGB', 'SOC', 'AGB_BGB_SOC']:
-	unr = raster('Base_Unr_{}_MgCha_500m.tif'.format(pool), verbose = True)
-	unr[cons > 0] = 0
-	write_gtiff(unr, 'Base_Con_Unr_{}_MgCha_500m.tif'.format(pool), dtype = 'Int16', gt = gt, sr = sr, nodata = -32768, stats = True, msg = True)
+pools = ['AGB', 'BGB', 'AGB_BGB', 'SOC', 'AGB_BGB_SOC']
+
+# constraint scenarios: constraint codes that mask unrealized potential
+# ('' = all four classes, written to Base_Con_Unr_*; others to Base_Con{name}_Unr_*)
+scenarios = collections.OrderedDict([('', [1, 2, 3, 4])])
+if args.sweep:
+	scenarios['Crop'] = [1, 2]
+	scenarios['CropPast'] = [1, 2, 3]
+	scenarios['Past'] = [3]
+	scenarios['Urbn'] = [4]
+
+inputs = {'cons': f_cons}
+outputs = {}
+for pool in pools:
+	inputs[pool] = 'Base_Unr_{}_MgCha_500m.tif'.format(pool)
+	for scn in scenarios:
+		outputs[scn + '_' + pool] = {'file': 'Base_Con{}_Unr_{}_MgCha_500m.tif'.format(scn, pool), 'dtype': 'Int16', 'nodata': -32768}
+
+def cons_block(blk):
+	res = {}
+	for scn, codes in scenarios.items():
+		# each constraint subset is evaluated once per block and applied to all pools
+		ind = np.isin(blk['cons'], codes)
+		for pool in pools:
+			res[scn + '_' + pool] = np.where(ind, 0, blk[pool])
+	return res
+
+if args.virtual:
+	for scn, codes in scenarios.items():
+		for pool in pools:
+			calc('np.where(np.isin(cons, {}), 0, unr)'.format(codes), inputs = {'cons': f_cons, 'unr': inputs[pool]}, out_tif = outputs[scn + '_' + pool]['file'], dtype = 'Int16', nodata = -32768, mask = [], virtual = True, msg = True)
+else:
+	# each constraints block is read once and applied to all five unrealized potential blocks,
+	# writing every pool (and scenario) output in the same pass
+	run_parallel(cons_block, inputs, outputs, workers = os.cpu_count(), stats = True, msg = True)
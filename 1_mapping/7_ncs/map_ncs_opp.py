@@ -1,103 +1,170 @@
 #!/usr/bin/env python3
 
+import argparse
+import sys
 from raspy import *
 import pandas as pd
 
+def argparse_init():
+	p = argparse.ArgumentParser(description = 'Map natural climate solution (NCS) opportunity categories.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+	p.add_argument('--thresholds', help = 'csv of biophysical/commercial thresholds (MgC/ha) and current:potential cut points per group of bioclimate zones', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ncs_thresholds.csv'))
+	p.add_argument('--sweep', help = 'csv of threshold sets (thresholds csv columns plus a "set" column): accumulate per-set category pixel counts and unrealized carbon per bioclimate zone in one pass, instead of mapping', default = None)
+	p.add_argument('--maps', help = 'threshold sets of the sweep to also write maps for', default = [], nargs = '+')
+	p.add_argument('--sweep_csv', help = 'output csv of the sweep', default = 'ncs_threshold_sweep.csv')
+	return p
+
 # -----------------------------------------------------------------
 # inputs
 # -----------------------------------------------------------------
 
-# biophysical thresholds (MgC/ha)
-brl_bt = 5
-tmp_bt = 5
-trp_bt = 20
-
-# commercial thresholds (MgC/ha)
-brl_ct = 50
-tmp_ct = 75
-trp_ct = 110
-
 # bioclimate zones (1 = polar; 2 = subtropics; 3 = temperate; 4 = tropics; 5 = boreal; 15 = nodata)
 f_bcz = 'Bioclimate_Zones_500m.tif'
-bcz = raster(f_bcz, verbose = True)
-gt, sr = get_gt_sr(f_bcz)
-
-# current AGB+BGB
-cur = raster('Base_Cur_AGB_BGB_MgCha_500m.tif', verbose = True)
-
-# potential AGB+BGB
-pot = raster('Base_Pot_AGB_BGB_MgCha_500m.tif', verbose = True)
-
-# potential SOC
-soc = raster('Base_Pot_SOC_MgCha_500m.tif', verbose = True)
-
-# unrealized AGB+BGB+SOC
-unr = raster('Base_Unr_AGB_BGB_SOC_MgCha_500m.tif', verbose = True)
 
-# societal constraints (0 = no constraint, 1-4 = constraint)
-con = raster('Societal_Constraints_500m.tif', verbose = True)
+inputs = {
+	'bcz': f_bcz,
+	'cur': 'Base_Cur_AGB_BGB_MgCha_500m.tif', # current AGB+BGB
+	'pot': 'Base_Pot_AGB_BGB_MgCha_500m.tif', # potential AGB+BGB
+	'soc': 'Base_Pot_SOC_MgCha_500m.tif', # potential SOC
+	'unr': 'Base_Unr_AGB_BGB_SOC_MgCha_500m.tif', # unrealized AGB+BGB+SOC
+	'con': 'Societal_Constraints_500m.tif' # societal constraints (0 = no constraint, 1-4 = constraint)
+}
+
+nd = -32768
+
+# ncs category by biomass potential bin (rows: pot <= 0; 0 < pot <= bio_thresh; bio_thresh < pot <= com_thresh; pot > com_thresh)
+# and current:potential bin (cols: c2p <= c2p_low; c2p_low < c2p <= c2p_high; c2p > c2p_high)
+categories = np.array([
+	[0, 0, 0],
+	[1, 1, 1],
+	[2, 3, 4],
+	[5, 6, 7]
+], dtype = np.uint8)
 
 # -----------------------------------------------------------------
-# ratio of current to potential
+# decision table
 # -----------------------------------------------------------------
 
-cur[cur == -32768] = 0
-pot[pot == -32768] = 0
-
-with np.errstate(invalid = 'ignore', divide = 'ignore'):
-	c2p = np.true_divide(cur, pot)
-
-del cur
-
-c2p[np.logical_or(np.isinf(c2p), np.isnan(c2p))] = 0
+def read_thresholds(f_thr):
+	"""Build the decision table from a thresholds csv (or data frame) with one row per group of bioclimate zones"""
+	df = pd.read_csv(f_thr) if type(f_thr) == str else f_thr.reset_index(drop = True)
+	codes = [[int(c) for c in str(s).split()] for s in df['bcz_codes']]
+	# bioclimate zone code -> threshold row (0 = not classified)
+	zone_lut = np.zeros(max(max(c) for c in codes) + 1, dtype = np.uint8)
+	for i, c in enumerate(codes): zone_lut[c] = i + 1
+	return {
+		'zone_lut': zone_lut,
+		'pot_breaks': [None] + [np.array([0, bt, ct]) for bt, ct in zip(df['bio_thresh'], df['com_thresh'])],
+		'c2p_breaks': [None] + [np.array([lo, hi]) for lo, hi in zip(df['c2p_low'], df['c2p_high'])],
+		# (threshold row, pot bin, c2p bin) -> category
+		'table': np.concatenate([np.zeros((1,) + categories.shape, dtype = np.uint8), np.broadcast_to(categories, (len(df.index),) + categories.shape)])
+	}
+
+def lookup(lut, codes):
+	# codes outside the lut get row 0
+	ids = np.zeros(codes.shape, dtype = lut.dtype)
+	ind = (codes >= 0) & (codes < lut.size)
+	ids[ind] = lut[codes[ind]]
+	return ids
+
+def ratio_c2p(cur, pot):
+	# ratio of current to potential (float64, 0 where undefined)
+	cur = np.where(cur == nd, 0, cur)
+	pot = np.where(pot == nd, 0, pot)
+	with np.errstate(invalid = 'ignore', divide = 'ignore'):
+		c2p = np.true_divide(cur, pot)
+	c2p[~np.isfinite(c2p)] = 0
+	return pot, c2p
+
+def classify(blk, thr, pot, c2p):
+	row = lookup(thr['zone_lut'], blk['bcz'])
+	pot_bin = np.zeros(row.shape, dtype = np.intp)
+	c2p_bin = np.zeros(row.shape, dtype = np.intp)
+	for r in range(1, len(thr['pot_breaks'])):
+		ind = row == r
+		if not ind.any(): continue
+		pot_bin[ind] = np.digitize(pot[ind], thr['pot_breaks'][r], right = True)
+		c2p_bin[ind] = np.digitize(c2p[ind], thr['c2p_breaks'][r], right = True)
+	ncs = thr['table'][row, pot_bin, c2p_bin]
+	
+	# nonwoody: no biomass potential but soil carbon
+	ncs[(row > 0) & (pot == 0) & (blk['soc'] > 0)] = 1
+	
+	# mask out pixels with no unrealized potential carbon
+	ncs[(blk['unr'] == nd) | (blk['unr'] == 0)] = 0
+	
+	# apply societal constraints
+	ncs[blk['con'] > 0] = 0
+	return ncs
+
+def ncs_block(blk, thr):
+	pot, c2p = ratio_c2p(blk['cur'], blk['pot'])
+	return classify(blk, thr, pot, c2p)
 
 # -----------------------------------------------------------------
-# map ncs opportunity space
+# threshold sweep
 # -----------------------------------------------------------------
 
-ncs = np.zeros(bcz.shape, dtype = np.int16)
-
-# boreal/polar
-ncs[((bcz == 1) | (bcz == 5)) & ( ((pot > 0) & (pot <= brl_bt)) | ((pot == 0) & (soc > 0)) )] = 1
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_bt) & (pot <= brl_ct)) & (c2p <= 0.25)] = 2
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_bt) & (pot <= brl_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 3
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_bt) & (pot <= brl_ct)) & (c2p > 0.90)] = 4
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_ct)) & (c2p <= 0.25)] = 5
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 6
-ncs[((bcz == 1) | (bcz == 5)) & ((pot > 0) & (pot > brl_ct)) & (c2p > 0.90)] = 7
-
-# temperate
-ncs[(bcz == 3) & ( ((pot > 0) & (pot <= tmp_bt)) | ((pot == 0) & (soc > 0)) )] = 1
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_bt) & (pot <= tmp_ct)) & (c2p <= 0.25)] = 2
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_bt) & (pot <= tmp_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 3
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_bt) & (pot <= tmp_ct)) & (c2p > 0.90)] = 4
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_ct)) & (c2p <= 0.25)] = 5
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 6
-ncs[(bcz == 3) & ((pot > 0) & (pot > tmp_ct)) & (c2p > 0.90)] = 7
-
-# tropical/subtropical
-ncs[((bcz == 2) | (bcz == 4)) & ( ((pot > 0) & (pot <= trp_bt)) | ((pot == 0) & (soc > 0)) )] = 1
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_bt) & (pot <= trp_ct)) & (c2p <= 0.25)] = 2
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_bt) & (pot <= trp_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 3
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_bt) & (pot <= trp_ct)) & (c2p > 0.90)] = 4
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_ct)) & (c2p <= 0.25)] = 5
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_ct)) & (c2p > 0.25) & (c2p <= 0.90)] = 6
-ncs[((bcz == 2) | (bcz == 4)) & ((pot > 0) & (pot > trp_ct)) & (c2p > 0.90)] = 7
-
-del bcz, pot, soc, c2p
-
-# mask out pixels with no unrealized potential carbon
-ncs[np.logical_or(unr == -32768, unr == 0)] = 0
-
-# apply societal constraints
-ncs[con > 0] = 0
+# bioclimate zone codes are tallied in [0, n_bcz) and categories in [0, n_ncs)
+n_bcz = 256
+n_ncs = 8
+
+def sweep_block(blk, thr_sets, maps):
+	
+	# shared by all threshold sets
+	pot, c2p = ratio_c2p(blk['cur'], blk['pot'])
+	bcz = blk['bcz']
+	bcz = np.where((bcz >= 0) & (bcz < n_bcz), bcz, 0).astype(np.intp).ravel()
+	unr = np.where(blk['unr'] == nd, 0, blk['unr']).astype(np.float64).ravel()
+	
+	res = {}
+	metrics = {}
+	for name, thr in thr_sets.items():
+		ncs = classify(blk, thr, pot, c2p)
+		key = bcz * n_ncs + ncs.ravel()
+		metrics[name + '_count'] = np.bincount(key, minlength = n_bcz * n_ncs)
+		metrics[name + '_unr'] = np.bincount(key, weights = unr, minlength = n_bcz * n_ncs)
+		if name in maps: res[name] = ncs
+	return res, metrics
+
+def sweep(f_sets, maps, f_out):
+	"""Classify with every threshold set of f_sets in one block-streamed pass, writing per-set category pixel counts and unrealized carbon (MgC) per bioclimate zone to f_out, and maps for the sets in maps"""
+	df = pd.read_csv(f_sets, dtype = {'set': str}) # set names are compared with --maps names
+	thr_sets = collections.OrderedDict((name, read_thresholds(df_set.drop(columns = 'set'))) for name, df_set in df.groupby('set', sort = False))
+	# check map names before any output raster is created
+	unknown = [name for name in maps if name not in thr_sets]
+	if unknown:
+		sys.exit('Error: --maps set(s) not found in {}: {} (sets: {})'.format(f_sets, ', '.join(unknown), ', '.join(thr_sets)))
+	outputs = {name: {'file': 'NCS_Opportunity_Categories_{}_500m.tif'.format(name), 'dtype': 'Byte', 'nodata': 0} for name in maps}
+	metrics = run_parallel(functools.partial(sweep_block, thr_sets = thr_sets, maps = maps), inputs, outputs, workers = os.cpu_count(), stats = True, msg = True)
+	
+	cell_area_ha = get_cell_area_ha(f_bcz)
+	rows = []
+	for name in thr_sets:
+		counts = metrics[name + '_count'].reshape(n_bcz, n_ncs)
+		unr = metrics[name + '_unr'].reshape(n_bcz, n_ncs)
+		for bcz_code, ncs_code in zip(*np.nonzero(counts)):
+			rows.append([name, bcz_code, ncs_code, counts[bcz_code, ncs_code], unr[bcz_code, ncs_code] * cell_area_ha])
+	df_out = pd.DataFrame(rows, columns = ['set', 'bcz_code', 'ncs_code', 'pixels', 'unr_mgc'])
+	df_out.to_csv(f_out, index = False)
+	print('Wrote {}'.format(f_out), flush = True)
 
 # -----------------------------------------------------------------
-# outputs
+# map ncs opportunity space
 # -----------------------------------------------------------------
 
-write_gtiff(ncs, out_tif = 'NCS_Opportunity_Categories_500m.tif', gt = gt, sr = sr, dtype = 'Byte', nodata = 0, stats = True, msg = True)
-
-dct = {'ncs_code': range(1, 8), 'ncs_name': ['Nonwoody', 'R/L', 'MM/L', 'M/L', 'R/H', 'MM/H', 'M/H']}
-df = pd.DataFrame.from_dict(dct)
-df.to_csv('ncs_opp_space.csv', index = False)
+def main():
+	args = argparse_init().parse_args()
+	if args.sweep != None:
+		sweep(args.sweep, args.maps, args.sweep_csv)
+		return
+	thr = read_thresholds(args.thresholds)
+	
+	outputs = {'ncs': {'file': 'NCS_Opportunity_Categories_500m.tif', 'dtype': 'Byte', 'nodata': 0}}
+	run_parallel(functools.partial(ncs_block, thr = thr), inputs, outputs, workers = os.cpu_count(), stats = True, msg = True)
+	
+	dct = {'ncs_code': range(1, 8), 'ncs_name': ['Nonwoody', 'R/L', 'MM/L', 'M/L', 'R/H', 'MM/H', 'M/H']}
+	df = pd.DataFrame.from_dict(dct)
+	df.to_csv('ncs_opp_space.csv', index = False)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# benchmark GeoTIFF creation profiles (raspy.GTIFF_PROFILES) on a synthetic 500m carbon density layer:
+# reports write time, full windowed read time, random window read time and file size per profile
+
+import argparse
+import tempfile
+import time
+from raspy import *
+
+# MODIS sinusoidal grid (500m)
+SINU_PROJ4 = '+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs'
+SINU_RES = 463.312716528
+
+def argparse_init():
+	p = argparse.ArgumentParser(description = 'Benchmark GeoTIFF creation profiles on a synthetic 500m Int16 layer.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+	p.add_argument('--rows', help = 'number of rows of the synthetic layer', default = 10000, type = int)
+	p.add_argument('--cols', help = 'number of columns of the synthetic layer', default = 20000, type = int)
+	p.add_argument('--profiles', help = 'profiles to benchmark', default = list(GTIFF_PROFILES), nargs = '+')
+	p.add_argument('--windows', help = 'number of random 512x512 windows to read', default = 200, type = int)
+	p.add_argument('--outdir', help = 'directory for the benchmark rasters (default: a temporary directory)', default = None)
+	return p
+
+def synthetic_block(row_off, nrows, ncols, nd = -32768):
+	"""Smooth carbon-density-like Int16 field with noise and nodata 'oceans'"""
+	rows = np.arange(row_off, row_off + nrows, dtype = np.float32)[:, None]
+	cols = np.arange(ncols, dtype = np.float32)[None, :]
+	field = 150 * (1 + np.sin(rows / 700.0) * np.cos(cols / 900.0)) + 40 * np.sin(cols / 53.0 + rows / 71.0)
+	rng = np.random.default_rng(row_off)
+	arr = np.rint(field + rng.normal(0, 5, size = (nrows, ncols))).astype(np.int16)
+	arr[arr < 20] = nd
+	return arr
+
+def bench_profile(profile, out_tif, args, nd = -32768):
+	gt = (-SINU_RES * args.cols / 2, SINU_RES, 0, SINU_RES * args.rows / 2, 0, -SINU_RES)
+	sr = osr.SpatialReference()
+	sr.ImportFromProj4(SINU_PROJ4)
+
+	t0 = time.perf_counter()
+	with BlockWriter(out_tif, args.cols, args.rows, 'Int16', gt, sr.ExportToWkt(), nodata = nd, stats = True, profile = profile) as out:
+		for row_off in range(0, args.rows, 512):
+			nrows = min(512, args.rows - row_off)
+			out.write(synthetic_block(row_off, nrows, args.cols, nd = nd), row_off, 0)
+	t_write = time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	for row_off, col_off, arrs in iter_blocks(out_tif, bands = 1):
+		pass
+	t_scan = time.perf_counter() - t0
+
+	rng = np.random.default_rng(0)
+	file = gdal.Open(out_tif)
+	t0 = time.perf_counter()
+	for i in range(args.windows):
+		row_off = int(rng.integers(0, max(1, args.rows - 512)))
+		col_off = int(rng.integers(0, max(1, args.cols - 512)))
+		read_window(file, row_off, col_off, min(512, args.rows), min(512, args.cols), bands = 1)
+	t_rand = time.perf_counter() - t0
+	file = None
+
+	size_mb = os.path.getsize(out_tif) / 2**20
+	return [t_write, t_scan, t_rand, size_mb]
+
+def main():
+	args = argparse_init().parse_args()
+	outdir = args.outdir if args.outdir != None else tempfile.mkdtemp(prefix = 'bench_gtiff_')
+	print('Synthetic Int16 layer: {} x {} ({:.0f} MB uncompressed)'.format(args.rows, args.cols, args.rows * args.cols * 2 / 2**20), flush = True)
+	print('{:<10}{:>10}{:>10}{:>12}{:>12}'.format('profile', 'write_s', 'scan_s', 'random_s', 'size_mb'), flush = True)
+	for profile in args.profiles:
+		out_tif = os.path.join(outdir, 'bench_{}.tif'.format(profile))
+		t_write, t_scan, t_rand, size_mb = bench_profile(profile, out_tif, args)
+		print('{:<10}{:>10.2f}{:>10.2f}{:>12.2f}{:>12.1f}'.format(profile, t_write, t_scan, t_rand, size_mb), flush = True)
+		if args.outdir == None: os.remove(out_tif)
+	if args.outdir == None: os.rmdir(outdir)
+
+if __name__ == '__main__':
+	main()
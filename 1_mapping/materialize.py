@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+# evaluate raspy virtual layer specs (*.vrl.json, see raspy.calc(virtual = True))
+# into the GeoTIFFs they stand in for, e.g., before publishing
+
+import argparse
+from raspy import *
+
+def argparse_init():
+	p = argparse.ArgumentParser(description = 'Materialise raspy virtual layers into GeoTIFFs.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+	p.add_argument('specs', help = 'virtual layer specs ({})'.format(VIRTUAL_EXT), nargs = '+')
+	p.add_argument('--profile', help = 'GeoTIFF creation profile (see raspy.GTIFF_PROFILES)', default = GTIFF_PROFILE)
+	p.add_argument('--workers', help = 'number of worker processes', default = os.cpu_count(), type = int)
+	p.add_argument('--remove', help = 'remove each spec once its GeoTIFF is written', action = 'store_true')
+	return p
+
+def main():
+	args = argparse_init().parse_args()
+	for vf in args.specs:
+		materialize(vf, workers = args.workers, profile = args.profile, stats = True, msg = True)
+		if args.remove: os.remove(vf)
+
+if __name__ == '__main__':
+	main()
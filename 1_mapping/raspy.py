@@ -5,82 +5,152 @@
 
 from osgeo import gdal, osr
 import numpy as np
-import subprocess as sp
 import os
+import collections
+import functools
+import hashlib
+import json
+import multiprocessing as mp
+
+# target number of pixels per window when iterating over a raster block-by-block
+BLOCK_PIXELS = 2**24
+
+# default memory budget (bytes) shared by all run_parallel() workers, and the assumed
+# ratio of peak per-window memory (temporaries included) to its input/output arrays
+MEM_BUDGET = 4 * 2**30
+TEMP_FACTOR = 4
+
+# named GeoTIFF creation profiles (see gtiff_options()); 'lzw' is the original striped LZW layout
+GTIFF_PROFILES = {
+	'lzw' : ['COMPRESS=LZW'],
+	'fast' : ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=ZSTD', 'ZSTD_LEVEL=1', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'],
+	'archive' : ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'ZLEVEL=9', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'],
+	'cog' : ['BLOCKSIZE=512', 'COMPRESS=DEFLATE', 'LEVEL=6', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS', 'OVERVIEWS=AUTO']
+}
+
+# default profile used by write_gtiff() and BlockWriter
+GTIFF_PROFILE = 'lzw'
+
+# opt-in cache of decoded rasters as uncompressed .npy files (see cache_raster()), and its size cap (bytes)
+CACHE_DIR = os.environ.get('RASPY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'raspy'))
+CACHE_MAX_BYTES = int(float(os.environ.get('RASPY_CACHE_MAX_GB', 100)) * 2**30)
+
+# relative accuracy of approximate quantiles of non-integer (or 32-bit+) data, see RunningStats
+SKETCH_ACCURACY = 0.001
+
+# maximum number of cells RunningStats.update() processes at once, bounding its temporaries
+STATS_PIXELS = 2**20
+
+# file extension of virtual layer specs (see calc(virtual = True))
+VIRTUAL_EXT = '.vrl.json'
+
+# -----------------------------------------------------------------
+# raster metadata
+# -----------------------------------------------------------------
+
+# all metadata of a raster file; nodata, dtype and block_size are tuples with one entry per band
+RasterInfo = collections.namedtuple('RasterInfo', ['file', 'ncol', 'nrow', 'nband', 'gt', 'sr', 'proj4', 'units', 'x_res', 'y_res', 'nodata', 'dtype', 'block_size'])
+
+def info(raster_file):
+	"""Get a RasterInfo with all metadata of a raster file, without loading it into memory.\nThe file is opened once and the result is cached until the file changes on disk (mtime or size). Virtual layers (see virtual_layer()) get the metadata of their first input, with their own data type and nodata value."""
+	vf = virtual_layer(raster_file)
+	if vf != None: raster_file = vf
+	st = os.stat(raster_file)
+	return _info(os.path.abspath(raster_file), st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize = 256)
+def _info(path, mtime, size):
+	if path.endswith(VIRTUAL_EXT):
+		spec = read_virtual(path)
+		ref = info(next(iter(spec['inputs'].values())))
+		return ref._replace(file = path, nband = 1, nodata = (spec['nodata'],), dtype = (spec['dtype'],), block_size = ref.block_size[0:1])
+	file = gdal.Open(path)
+	gt = file.GetGeoTransform()
+	sr = file.GetProjection()
+	proj4 = osr.SpatialReference(wkt = sr).ExportToProj4().rstrip()
+	units = [x.strip().split('=')[1] for x in proj4.split('+') if 'units' in x]
+	bands = [file.GetRasterBand(band) for band in range(1, file.RasterCount + 1)]
+	nodata = tuple(b.GetNoDataValue() for b in bands)
+	dtype = tuple(gdal.GetDataTypeName(b.DataType) for b in bands)
+	block_size = tuple(tuple(b.GetBlockSize()[::-1]) for b in bands)
+	raster_info = RasterInfo(path, file.RasterXSize, file.RasterYSize, file.RasterCount, gt, sr, proj4, units[0] if units else None, gt[1], -gt[5], nodata, dtype, block_size)
+	bands = None
+	file = None
+	return raster_info
+
+# per-process pool of open read-only datasets, see open_dataset()
+DATASET_POOL_SIZE = 64
+_dataset_pool = collections.OrderedDict()
+_dataset_pool_pid = [os.getpid()]
+
+def open_dataset(raster_file):
+	"""Get a read-only GDAL dataset handle from a per-process pool of open files, so that repeated reads of the same raster do not reopen it.\nHandles are reopened if the file changed on disk, and never shared across processes."""
+	if _dataset_pool_pid[0] != os.getpid():
+		# handles inherited from a forked parent share its file offsets
+		_dataset_pool.clear()
+		_dataset_pool_pid[0] = os.getpid()
+	path = os.path.abspath(raster_file)
+	st = os.stat(path)
+	key = (st.st_mtime_ns, st.st_size)
+	if path in _dataset_pool:
+		file_key, file = _dataset_pool.pop(path)
+		if file_key == key:
+			_dataset_pool[path] = (key, file)
+			return file
+	file = gdal.Open(path)
+	_dataset_pool[path] = (key, file)
+	while len(_dataset_pool) > DATASET_POOL_SIZE:
+		_dataset_pool.popitem(last = False)
+	return file
 
 def get_nodata(raster_file, band = 1):
 	"""Get raster nodata value"""
-	file = gdal.Open(raster_file)
-	nodata = file.GetRasterBand(band).GetNoDataValue()
-	file = None
-	return nodata
+	return info(raster_file).nodata[band - 1]
 
 def get_gt_sr(raster_file):
 	"""Get geotransform"""
-	file = gdal.Open(raster_file)
-	gt = file.GetGeoTransform()
-	sr = file.GetProjection()
-	file = None
-	return [gt, sr]
+	raster_info = info(raster_file)
+	return [raster_info.gt, raster_info.sr]
 
 def get_proj4str(raster_file):
 	"""Get proj4 string"""
-	file = gdal.Open(raster_file)
-	proj = osr.SpatialReference(wkt = file.GetProjection()).ExportToProj4().rstrip()
-	file = None
-	return proj
+	return info(raster_file).proj4
 
 def get_nbands(raster_file):
 	"""Get number of bands"""
-	file = gdal.Open(raster_file)
-	num_bands = file.RasterCount
-	file = None
-	return num_bands
+	return info(raster_file).nband
 
 def get_dims(raster_file):
 	"""Get dimensions of raster file, without loading it into memory"""
-	file = gdal.Open(raster_file)
-	num_cols = file.RasterXSize
-	num_rows = file.RasterYSize
-	num_bands = file.RasterCount
-	file = None
-	return [num_cols, num_rows, num_bands]
+	raster_info = info(raster_file)
+	return [raster_info.ncol, raster_info.nrow, raster_info.nband]
+
+def get_block_size(raster_file, band = 1):
+	"""Get native block dimensions [rows, cols] of raster file (e.g., GeoTIFF strips or tiles), without loading it into memory"""
+	return list(info(raster_file).block_size[band - 1])
 
 def get_xy_res(raster_file):
 	"""Get X and Y resolution of raster file, without loading it into memory"""
-	file = gdal.Open(raster_file)
-	gt = file.GetGeoTransform()
-	file = None
-	x_res = gt[1]
-	y_res = -gt[5]
-	return [x_res, y_res]
+	raster_info = info(raster_file)
+	return [raster_info.x_res, raster_info.y_res]
 
 def get_prj_units(raster_file):
 	"""Get units of raster file CRS, without loading it into memory"""
-	prj4_str = get_proj4str(raster_file)
-	prj4_str_list = prj4_str.split('+')
-	units_str = list(filter(lambda x: 'units' in x, prj4_str_list))[0]
-	units_str = units_str.strip().split('=')[1]
-	return units_str
+	return info(raster_file).units
 
 def get_cell_area_ha(raster_file):
 	"""Get grid cell area (ha) of raster file, without loading it into memory"""
-	units = get_prj_units(raster_file)
-	if units == 'm':
-		x_res, y_res = get_xy_res(raster_file)
-		area_ha = x_res * y_res * 1e-4
+	raster_info = info(raster_file)
+	if raster_info.units == 'm':
+		area_ha = raster_info.x_res * raster_info.y_res * 1e-4
 		return area_ha
 	else:
-		print('Error: CRS units are {} (must be meters).'.format(units), flush = True)
+		print('Error: CRS units are {} (must be meters).'.format(raster_info.units), flush = True)
 		return
 
 def get_dtype(raster_file, band = 1):
 	"""Get raster data type"""
-	file = gdal.Open(raster_file)
-	dtype_int = file.GetRasterBand(band).DataType
-	dtype_str = gdal.GetDataTypeName(dtype_int)
-	file = None
-	return dtype_str
+	return info(raster_file).dtype[band - 1]
 
 def dtype_gdal(dtype_str):
 	"""Translate data type from string to GDAL data type (integer)"""
@@ -119,33 +189,687 @@ def dtype_bit_depth(dtype_str):
 	bit_depth = bit_depth_switcher.get(dtype_str, 0)
 	return bit_depth
 
-def raster(raster_file, bands = None, verbose = False):
-	"""Load single- or multi-band raster from disk into a 2- or 3-dimensional numpy array in memory.\nNote, bands must be INTEGER or LIST of integers, e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0."""
+def dtype_numpy(dtype_str):
+	"""Translate data type from string to numpy data type"""
+	numpy_switcher = {
+		"Byte" : np.uint8,
+		"UInt16" : np.uint16,
+		"Int16" : np.int16,
+		"UInt32" : np.uint32,
+		"Int32" : np.int32,
+		"Float32" : np.float32,
+		"Float64" : np.float64,
+		"CInt16" : np.complex64,   # numpy has no complex integers; GDAL reads these as complex floats
+		"CInt32" : np.complex128,
+		"CFloat32" : np.complex64,
+		"CFloat64" : np.complex128
+	}
+	np_dtype = numpy_switcher.get(dtype_str, None)
+	return np_dtype
+
+def dtype_from_numpy(np_dtype):
+	"""Translate numpy data type to data type string (GDAL buffer type), or None if GDAL has no matching type"""
+	name_switcher = {
+		"uint8" : "Byte",
+		"uint16" : "UInt16",
+		"int16" : "Int16",
+		"uint32" : "UInt32",
+		"int32" : "Int32",
+		"float32" : "Float32",
+		"float64" : "Float64",
+		"complex64" : "CFloat32",
+		"complex128" : "CFloat64"
+	}
+	dtype_str = name_switcher.get(np.dtype(np_dtype).name, None)
+	return dtype_str
+
+def gdal_cast(arr, dtype_str):
+	"""Convert a numpy array to a raster data type the way GDAL does when writing it: to integer types, floats are rounded half away from zero (NaN to 0) and values are clamped to the type's range"""
+	np_dtype = dtype_numpy(dtype_str)
+	if (np_dtype == None) or (arr.dtype == np_dtype) or (np.dtype(np_dtype).kind not in 'iu') or (arr.dtype.kind == 'c'): return arr
+	if arr.dtype.kind == 'b': return arr.astype(np_dtype)
+	if arr.dtype.kind == 'f':
+		with np.errstate(invalid = 'ignore'):
+			arr = np.trunc(arr + np.copysign(0.5, arr))
+		arr = np.where(np.isnan(arr), 0, arr)
+	type_info = np.iinfo(np_dtype)
+	return np.clip(arr, type_info.min, type_info.max).astype(np_dtype)
+
+def raster(raster_file, bands = None, verbose = False, cache = False, window = None, out = None):
+	"""Load single- or multi-band raster from disk into a 2- or 3-dimensional numpy array in memory.\nNote, bands must be INTEGER or LIST of integers, e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0.\nwindow = [row_off, col_off, nrows, ncols] reads only part of the raster. If out is a preallocated (possibly memory-mapped) array of the right shape, data are read directly into it, band by band, and out is returned.\nIf cache = True (or the raster was registered with cache_layer()), a copy-on-write np.memmap of the decoded raster in the cache is returned instead (see cache_raster()).\nVirtual layers (see virtual_layer()) are evaluated on the fly."""
+	if (type(bands) != int) and (type(bands) != list) and (bands != None):
+		print('Error: bands argument must be type INTEGER or LIST (of integers), e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0.', flush = True)
+		return
+	vf = virtual_layer(raster_file)
+	if (vf != None) and not cache:
+		if verbose: print('Evaluating virtual layer {} ...'.format(vf), flush = True)
+		raster_info = info(vf)
+		if window == None: window = [0, 0, raster_info.nrow, raster_info.ncol]
+		arr = read_input(vf, *window)
+		if out is not None:
+			out[...] = arr
+			return out
+		return arr
+	registered = (bands in [None, 1]) and (os.path.abspath(raster_file) in _cached_layers)
+	if registered or cache:
+		arr = cache_raster(raster_file, bands = 1 if registered else bands, verbose = verbose)
+		if window != None:
+			row_off, col_off, nrows, ncols = window
+			arr = arr[..., row_off:(row_off + nrows), col_off:(col_off + ncols)]
+		if out is not None:
+			out[...] = arr
+			return out
+		return arr
 	if verbose: print('Reading {} ...'.format(raster_file), flush = True)
 	file = gdal.Open(raster_file)
 	tot_band_cnt = file.RasterCount
 	if bands == None:
 		if (verbose) & (tot_band_cnt == 1): print('Raster has 1 band ...', flush = True)
 		if (verbose) & (tot_band_cnt > 1): print('Reading all {} bands ...'.format(tot_band_cnt), flush = True)
-		arr = file.ReadAsArray()
 	elif type(bands) == int: # in this case, "bands" refers to only one band
 		if verbose: print('Reading band {} of {} ...'.format(bands, tot_band_cnt), flush = True)
-		arr = file.GetRasterBand(bands).ReadAsArray()
-	elif type(bands) == list:
-		arr_list = []
-		for band in bands:
-			if verbose: print('Reading band {} ...'.format(band), flush = True)
-			tmp_arr = file.GetRasterBand(band).ReadAsArray()
-			arr_list.append(tmp_arr)
-		arr = np.stack(arr_list, axis = 0)
 	else:
-		print('Error: bands argument must be type INTEGER or LIST (of integers), e.g., [1, 3, 6] = Bands 1, 3 and 6. There is no Band 0.', flush = True)
-		return
+		if verbose: print('Reading bands {} ...'.format(', '.join(str(band) for band in bands)), flush = True)
+	if window == None: window = [0, 0, file.RasterYSize, file.RasterXSize]
+	row_off, col_off, nrows, ncols = window
+	arr = read_window(file, row_off, col_off, nrows, ncols, bands = bands, out = out)
 	file = None
 	return arr
 	
-def write_gtiff(img_arr, out_tif, dtype, gt, sr, nodata = None, stats = True, msg = False):
-	"""Write a 2D numpy image array to a GeoTIFF raster file on disk"""
+def block_windows(raster_file, block_shape = None, max_pixels = BLOCK_PIXELS):
+	"""List [row_off, col_off, nrows, ncols] windows that tile a raster, following its native block layout.\nBy default, native blocks (strips or tiles) are grouped into windows of up to max_pixels cells; block_shape = [rows, cols] overrides this."""
+	num_cols, num_rows, num_bands = get_dims(raster_file)
+	if block_shape == None:
+		block_rows, block_cols = get_block_size(raster_file)
+		if num_cols * block_rows <= max_pixels:
+			# full-width windows spanning a whole number of strips/tile rows
+			block_rows = max(1, (max_pixels // num_cols) // block_rows) * block_rows
+			block_cols = num_cols
+		else:
+			block_cols = max(1, (max_pixels // block_rows) // block_cols) * block_cols
+	else:
+		block_rows, block_cols = block_shape
+	windows = []
+	for row_off in range(0, num_rows, block_rows):
+		for col_off in range(0, num_cols, block_cols):
+			windows.append([row_off, col_off, min(block_rows, num_rows - row_off), min(block_cols, num_cols - col_off)])
+	return windows
+
+def read_window(file, row_off, col_off, nrows, ncols, bands = None, out = None):
+	"""Read a window of an open GDAL dataset into a 2- or 3-dimensional numpy array (see raster() for bands).\nIf out is given, data are read directly into it (band by band for 3D arrays) through GDAL's buf_obj, and out is returned."""
+	if bands == None:
+		bands = 1 if file.RasterCount == 1 else list(range(1, file.RasterCount + 1))
+	if type(bands) == int:
+		return file.GetRasterBand(bands).ReadAsArray(col_off, row_off, ncols, nrows, buf_obj = out)
+	if out is None:
+		dtype = dtype_numpy(gdal.GetDataTypeName(file.GetRasterBand(bands[0]).DataType))
+		out = np.empty((len(bands), nrows, ncols), dtype = dtype)
+	for i, band in enumerate(bands):
+		file.GetRasterBand(band).ReadAsArray(col_off, row_off, ncols, nrows, buf_obj = out[i])
+	return out
+
+def window_buffer(buffers, raster_file, nrows, ncols, bands = None):
+	"""Get an array for reading a window of a raster (see read_window()), backed by a reusable flat buffer kept in the buffers dict, which only grows when a larger window is requested"""
+	raster_info = info(raster_file)
+	if bands == None:
+		bands = 1 if raster_info.nband == 1 else list(range(1, raster_info.nband + 1))
+	shape = (nrows, ncols) if type(bands) == int else (len(bands), nrows, ncols)
+	dtype = dtype_numpy(raster_info.dtype[(bands if type(bands) == int else bands[0]) - 1])
+	size = nrows * ncols * (1 if type(bands) == int else len(bands))
+	key = (raster_file, str(bands))
+	if (key not in buffers) or (buffers[key].size < size):
+		buffers[key] = np.empty(size, dtype = dtype)
+	return buffers[key][:size].reshape(shape)
+
+# -----------------------------------------------------------------
+# memory-mapped raster cache
+# -----------------------------------------------------------------
+
+# layers registered with cache_layer(), and cached files already built or found by this process
+_cached_layers = set()
+_cache_files = {}
+
+def cache_raster(raster_file, bands = None, cache_dir = None, verbose = False):
+	"""Decode a raster once into an uncompressed .npy file in the cache directory (keyed by path, mtime and size, or for virtual layers by layer_fingerprint()) and return a zero-copy, copy-on-write np.memmap of it.\nEvery call returns a new, independent mapping, so in-place edits by one caller are never seen by others. Later calls for the same unchanged file only map the cached file. The cache directory (default: CACHE_DIR) is kept under CACHE_MAX_BYTES by removing its least recently used files."""
+	if cache_dir == None: cache_dir = CACHE_DIR
+	vf = virtual_layer(raster_file)
+	path = os.path.abspath(raster_file if vf == None else vf)
+	if vf == None:
+		st = os.stat(path)
+		key = '{}|{}|{}|{}'.format(path, st.st_mtime_ns, st.st_size, bands)
+	else:
+		# virtual layers go stale whenever the spec or any of its inputs changes
+		key = '{}|{}|{}'.format(path, layer_fingerprint(vf), bands)
+	if (key in _cache_files) and os.path.exists(_cache_files[key]): return np.load(_cache_files[key], mmap_mode = 'c')
+	npy = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+	if os.path.exists(npy):
+		os.utime(npy) # mark as recently used
+	else:
+		if verbose: print('Caching {} ...'.format(raster_file), flush = True)
+		os.makedirs(cache_dir, exist_ok = True)
+		raster_info = info(path)
+		nband = raster_info.nband if bands == None else (1 if type(bands) == int else len(bands))
+		shape = (raster_info.nrow, raster_info.ncol) if nband == 1 and type(bands) != list else (nband, raster_info.nrow, raster_info.ncol)
+		band1 = bands if type(bands) == int else (bands[0] if type(bands) == list else 1)
+		tmp = '{}.{}.tmp'.format(npy, os.getpid())
+		mm = np.lib.format.open_memmap(tmp, mode = 'w+', dtype = dtype_numpy(raster_info.dtype[band1 - 1]), shape = shape)
+		vf = virtual_layer(path)
+		file = open_dataset(path) if vf == None else None
+		for row_off, col_off, nrows, ncols in block_windows(path):
+			if vf != None:
+				mm[..., row_off:(row_off + nrows), col_off:(col_off + ncols)] = read_virtual_window(vf, row_off, col_off, nrows, ncols)
+			else:
+				mm[..., row_off:(row_off + nrows), col_off:(col_off + ncols)] = read_window(file, row_off, col_off, nrows, ncols, bands = bands)
+		mm.flush()
+		mm = None
+		os.replace(tmp, npy)
+		trim_cache(cache_dir, keep = npy)
+	if verbose: print('Mapping cached {} ...'.format(raster_file), flush = True)
+	_cache_files[key] = npy
+	return np.load(npy, mmap_mode = 'c')
+
+def trim_cache(cache_dir = None, max_bytes = None, keep = None):
+	"""Remove least recently used files from the raster cache until it is under max_bytes (default: CACHE_MAX_BYTES)"""
+	if cache_dir == None: cache_dir = CACHE_DIR
+	if max_bytes == None: max_bytes = CACHE_MAX_BYTES
+	files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.npy')]
+	files = sorted([(os.stat(f).st_mtime, os.stat(f).st_size, f) for f in files])
+	total = sum(size for mtime, size, f in files)
+	for mtime, size, f in files:
+		if total <= max_bytes: break
+		if f == keep: continue
+		os.remove(f)
+		total -= size
+
+def cache_layer(raster_file, verbose = False):
+	"""Register a hot (single-band) layer so that raster(), iter_blocks() and run_parallel() read it from the memory-mapped cache, building the cache now if needed"""
+	cache_raster(raster_file, bands = 1, verbose = verbose)
+	_cached_layers.add(os.path.abspath(raster_file))
+
+def read_input(raster_file, row_off, col_off, nrows, ncols, bands = None, buffers = None):
+	"""Read a window of a raster file, as a zero-copy view of the memory-mapped cache if the layer was registered with cache_layer(), by evaluating it if it is a virtual layer (see virtual_layer()), otherwise through a pooled GDAL dataset (into a reused buffer from the buffers dict, if given)"""
+	if (bands in [None, 1]) and (os.path.abspath(raster_file) in _cached_layers):
+		return cache_raster(raster_file, bands = 1)[row_off:(row_off + nrows), col_off:(col_off + ncols)]
+	vf = virtual_layer(raster_file)
+	if vf != None:
+		return read_virtual_window(vf, row_off, col_off, nrows, ncols, buffers = buffers)
+	out = window_buffer(buffers, raster_file, nrows, ncols, bands = bands) if buffers != None else None
+	return read_window(open_dataset(raster_file), row_off, col_off, nrows, ncols, bands = bands, out = out)
+
+def iter_blocks(files, block_shape = None, bands = None, reuse = False, verbose = False):
+	"""Iterate over aligned windows of one or more rasters of the same dimensions, yielding (row_off, col_off, [arr, ...]) with one array per input.\nWindows follow the native block layout of the first raster (see block_windows()), so memory use is bounded by the window size.\nIf reuse = True, each input is read into the same buffer for every window, so arrays are only valid until the next iteration (copy them to keep them)."""
+	if type(files) == str: files = [files]
+	dims = [get_dims(f)[0:2] for f in files]
+	if any(d != dims[0] for d in dims):
+		print('Error: input rasters must have the same dimensions.', flush = True)
+		return
+	windows = block_windows(files[0], block_shape = block_shape)
+	if verbose: print('Reading {} raster(s) in {} windows ...'.format(len(files), len(windows)), flush = True)
+	buffers = [{} if reuse else None for f in files]
+	for row_off, col_off, nrows, ncols in windows:
+		arrs = [read_input(f, row_off, col_off, nrows, ncols, bands = bands, buffers = buffers[i]) for i, f in enumerate(files)]
+		yield row_off, col_off, arrs
+
+class RunningStats(object):
+	"""One-pass, mergeable descriptive statistics (count, min, max, mean, std) of the valid (non-nodata, non-NaN) cells of arrays seen block-by-block.\nIf hist = True, the distribution of values is also kept for histograms and quantiles: as exact counts for 8- and 16-bit integer data,\nor otherwise as a log-binned sketch with relative accuracy SKETCH_ACCURACY (DDSketch-style, also mergeable)."""
+	
+	def __init__(self, nodata = None, hist = False):
+		self.nodata = nodata
+		self.count = 0
+		self.min = None
+		self.max = None
+		self.mean = 0.0
+		self.m2 = 0.0 # sum of squared deviations from the mean
+		self.hist = hist
+		self.hist_offset = 0
+		self.counts = None # exact counts of integer values
+		self.sketch = None # {bin index: count} of positive and negative values, and count of zeros
+	
+	def update(self, arr, dtype = None):
+		"""Add the valid cells of a numpy array, in chunks of up to STATS_PIXELS cells along its first axis (e.g., rows).\nIf dtype (data type string) is given, values are first converted to it as GDAL writes them (see gdal_cast())."""
+		if (arr.ndim > 0) and (arr.size > STATS_PIXELS):
+			rows = max(1, STATS_PIXELS // max(1, arr.size // arr.shape[0]))
+			for i in range(0, arr.shape[0], rows): self._update(arr[i:(i + rows)], dtype)
+			return
+		self._update(arr, dtype)
+	
+	def _update(self, arr, dtype = None):
+		if dtype != None: arr = gdal_cast(arr, dtype)
+		valid = None
+		if self.nodata != None: valid = arr != self.nodata
+		if arr.dtype.kind == 'f':
+			valid = ~np.isnan(arr) if valid is None else (valid & ~np.isnan(arr))
+		vals = arr.ravel() if valid is None else arr[valid]
+		n = vals.size
+		if n == 0: return
+		mean = vals.mean(dtype = np.float64)
+		m2 = np.square(vals - mean, dtype = np.float64).sum()
+		self._merge(n, vals.min(), vals.max(), mean, m2)
+		if not self.hist: return
+		if (vals.dtype.kind in 'iu') and (vals.dtype.itemsize <= 2):
+			if self.counts is None:
+				self.hist_offset = int(np.iinfo(vals.dtype).min)
+				self.counts = np.zeros(2**(8 * vals.dtype.itemsize), dtype = np.int64)
+			self.counts += np.bincount((vals.astype(np.int64) - self.hist_offset), minlength = self.counts.size)
+		else:
+			if self.sketch is None: self.sketch = [{}, {}, 0]
+			log_gamma = np.log((1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY))
+			for sign, part in enumerate([vals[vals > 0], -vals[vals < 0]]):
+				ind, cnt = np.unique(np.ceil(np.log(part.astype(np.float64)) / log_gamma).astype(np.int64), return_counts = True)
+				bins = self.sketch[sign]
+				for i, c in zip(ind.tolist(), cnt.tolist()): bins[i] = bins.get(i, 0) + c
+			self.sketch[2] += int(np.count_nonzero(vals == 0))
+	
+	def merge(self, other):
+		"""Merge statistics of another RunningStats into this one"""
+		if other.count == 0: return
+		self._merge(other.count, other.min, other.max, other.mean, other.m2)
+		if self.hist and (other.counts is not None):
+			if self.counts is None:
+				self.hist_offset = other.hist_offset
+				self.counts = other.counts.copy()
+			else:
+				self.counts += other.counts
+		if self.hist and (other.sketch is not None):
+			if self.sketch is None: self.sketch = [{}, {}, 0]
+			for sign in [0, 1]:
+				for i, c in other.sketch[sign].items(): self.sketch[sign][i] = self.sketch[sign].get(i, 0) + c
+			self.sketch[2] += other.sketch[2]
+	
+	def _merge(self, n, vmin, vmax, mean, m2):
+		# pairwise update of mean and sum of squares (Chan et al.)
+		tot = self.count + n
+		delta = mean - self.mean
+		self.mean += delta * n / tot
+		self.m2 += m2 + delta**2 * self.count * n / tot
+		self.count = tot
+		self.min = vmin if self.min is None else min(self.min, vmin)
+		self.max = vmax if self.max is None else max(self.max, vmax)
+	
+	@property
+	def std(self):
+		"""Population standard deviation"""
+		return np.sqrt(self.m2 / self.count) if self.count > 0 else None
+	
+	def histogram(self, buckets = 256):
+		"""Get [min, max, counts] of a histogram with up to the given number of equal-width buckets spanning the data range (bucket edges at +/- 0.5 of integer values, as GDAL does).\nOnly available for exact (8- and 16-bit integer) counts."""
+		if (self.counts is None) or (self.count == 0): return
+		vmin = int(self.min)
+		vmax = int(self.max)
+		counts = self.counts[(vmin - self.hist_offset):(vmax - self.hist_offset + 1)]
+		buckets = min(buckets, counts.size)
+		ind = ((np.arange(counts.size) + 0.5) * buckets / counts.size).astype(np.int64)
+		hist = np.bincount(ind, weights = counts, minlength = buckets).astype(np.int64)
+		return [vmin - 0.5, vmax + 0.5, hist.tolist()]
+	
+	def _value_counts(self):
+		# sorted (value, count) arrays of the kept distribution
+		if self.counts is not None:
+			ind = np.flatnonzero(self.counts)
+			return [ind + self.hist_offset, self.counts[ind]]
+		gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+		pos = sorted(self.sketch[0].items())
+		neg = sorted(self.sketch[1].items(), reverse = True)
+		values = [-2 * gamma**i / (gamma + 1) for i, c in neg] + [0.0] + [2 * gamma**i / (gamma + 1) for i, c in pos]
+		counts = [c for i, c in neg] + [self.sketch[2]] + [c for i, c in pos]
+		return [np.array(values, dtype = np.float64), np.array(counts, dtype = np.int64)]
+	
+	def quantile(self, q):
+		"""Get the q-th quantile(s) (0 <= q <= 1) of the values seen, with linear interpolation between ranks as in np.quantile (requires hist = True)"""
+		if (not self.hist) or (self.count == 0): return
+		values, counts = self._value_counts()
+		cum = np.cumsum(counts)
+		# virtual index and interpolation computed exactly as np.quantile's default (linear) method
+		q = np.asarray(q, dtype = np.float64)
+		pos = self.count * q + (1 + q * -1) - 1
+		lo = np.floor(pos)
+		t = pos - lo
+		lo = np.clip(lo, 0, self.count - 1).astype(np.int64)
+		hi = np.minimum(lo + 1, self.count - 1)
+		v_lo = values[np.searchsorted(cum, lo, side = 'right')].astype(np.float64)
+		v_hi = values[np.searchsorted(cum, hi, side = 'right')].astype(np.float64)
+		diff = v_hi - v_lo
+		res = np.where(t >= 0.5, v_hi - diff * (1 - t), v_lo + diff * t)
+		# the sketch's bin representatives may fall slightly outside the exact data range
+		res = np.clip(res, float(self.min), float(self.max))
+		return res.item() if res.ndim == 0 else res
+
+def gtiff_options(profile, dtype):
+	"""Get GeoTIFF creation options for a named profile (see GTIFF_PROFILES) and output data type.\nA horizontal (integer) or floating point predictor is added to compressed profiles, and ZSTD falls back to LZW if GDAL was built without it.\nA list of creation options may also be given as the profile, and is returned as-is."""
+	if type(profile) == list: return profile
+	if profile not in GTIFF_PROFILES:
+		raise ValueError('unknown GeoTIFF profile: {} (must be one of {})'.format(profile, ', '.join(GTIFF_PROFILES)))
+	options = list(GTIFF_PROFILES[profile])
+	if 'COMPRESS=ZSTD' in options:
+		if 'ZSTD' not in (gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''):
+			options = [o for o in options if not o.startswith('ZSTD_LEVEL')]
+			options[options.index('COMPRESS=ZSTD')] = 'COMPRESS=LZW'
+	if profile == 'cog':
+		options.append('PREDICTOR=YES')
+	elif profile != 'lzw':
+		options.append('PREDICTOR=3' if dtype.startswith('Float') else 'PREDICTOR=2')
+	return options
+
+class BlockWriter(object):
+	"""Write a GeoTIFF raster to disk one window at a time, so the full image never needs to be held in memory.\nUse as a context manager, or call close() when done to flush the file.\nIf stats = True, min/max/mean/std (and, if hist = True, a default histogram) are computed in-process from the data as it is written and stored with the raster.\nprofile selects the creation options (see gtiff_options()); 'cog' outputs are written to a temporary tiled GeoTIFF and converted to a Cloud Optimized GeoTIFF on close.\nMulti-band outputs (nband > 1) are 'pixel' or 'band' interleaved, and nodata and descriptions may be given per band as lists. metadata is an optional dict of dataset metadata items."""
+	
+	def __init__(self, out_tif, ncol, nrow, dtype, gt, sr, nodata = None, stats = True, hist = False, profile = None, nband = 1, interleave = 'pixel', descriptions = None, metadata = None, msg = False):
+		dtype_int = dtype_gdal(dtype)
+		if dtype_int == 0:
+			raise ValueError('output data type invalid: {}'.format(dtype))
+		if interleave not in ['pixel', 'band']:
+			raise ValueError('interleave must be \'pixel\' or \'band\'')
+		if profile == None: profile = GTIFF_PROFILE
+		if msg: print('Writing {} ...'.format(out_tif), flush = True)
+		self.out_tif = out_tif
+		self.dtype = dtype
+		self.nband = nband
+		nodata = nodata if type(nodata) == list else [nodata] * nband
+		nodata = [None if (nd == None) or (type(nd) == str) else nd for nd in nodata]
+		self.stats = [RunningStats(nodata = nd, hist = hist) for nd in nodata] if stats else None
+		self.cog_options = None
+		options = gtiff_options(profile, dtype)
+		if profile == 'cog':
+			# the COG driver only supports CreateCopy(), so write a tiled GeoTIFF first
+			self.cog_options = options
+			out_tif = out_tif + '.tmp.tif'
+			options = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=IF_SAFER']
+		if nband > 1: options = options + ['INTERLEAVE={}'.format(interleave.upper())]
+		self.tmp_tif = out_tif
+		driver = gdal.GetDriverByName('GTiff')
+		self.dataset = driver.Create(out_tif, ncol, nrow, nband, dtype_int, options = options)
+		self.dataset.SetGeoTransform(gt)
+		self.dataset.SetProjection(sr)
+		for key, value in (metadata if metadata != None else {}).items():
+			self.dataset.SetMetadataItem(key, str(value))
+		for band in range(1, nband + 1):
+			if nodata[band - 1] != None:
+				self.dataset.GetRasterBand(band).SetNoDataValue(nodata[band - 1])
+			if descriptions != None:
+				self.dataset.GetRasterBand(band).SetDescription(descriptions[band - 1])
+	
+	def write(self, arr, row_off = 0, col_off = 0, band = None, update_stats = True):
+		"""Write a numpy array into the output raster at the given row/column offsets: a 3D array (band, row, col) fills all bands, a 2D array fills the given band (default: band 1).
+If update_stats = False, statistics of the array are not computed here (e.g., because they were computed elsewhere and are added with merge_stats())."""
+		if arr.ndim == 3:
+			# write all bands of each chunk of rows in one dataset-level call, so that pixel-interleaved
+			# blocks are filled (and compressed) once rather than once per band; as with WriteArray(),
+			# the buffer keeps the array's own type and GDAL converts (rounding and clamping) to the output type
+			block_rows = self.dataset.GetRasterBand(1).GetBlockSize()[1]
+			rows = max(1, (BLOCK_PIXELS // max(1, arr.shape[0] * arr.shape[2])) // block_rows) * block_rows
+			for i in range(0, arr.shape[1], rows):
+				chunk = arr[:, i:(i + rows)]
+				if dtype_from_numpy(chunk.dtype) == None:
+					# types without a GDAL buffer type are first widened (bool and int8 losslessly)
+					chunk = chunk.astype(np.uint8 if chunk.dtype.kind == 'b' else (np.int16 if chunk.dtype.itemsize == 1 else np.float64))
+				chunk = np.ascontiguousarray(chunk)
+				self.dataset.WriteRaster(col_off, row_off + i, chunk.shape[2], chunk.shape[1], chunk.tobytes(), buf_type = dtype_gdal(dtype_from_numpy(chunk.dtype)), band_list = list(range(1, arr.shape[0] + 1)))
+			if (self.stats != None) and update_stats:
+				for i in range(arr.shape[0]): self.stats[i].update(arr[i], dtype = self.dtype)
+			return
+		if band == None: band = 1
+		self.dataset.GetRasterBand(band).WriteArray(arr, xoff = col_off, yoff = row_off)
+		if (self.stats != None) and update_stats: self.stats[band - 1].update(arr, dtype = self.dtype)
+	
+	def merge_stats(self, band_stats):
+		"""Merge a list of RunningStats (one per band) of data written with update_stats = False"""
+		if self.stats == None: return
+		for rs, other in zip(self.stats, band_stats): rs.merge(other)
+	
+	def close(self):
+		"""Store statistics, then flush and close the output raster"""
+		if self.dataset == None: return
+		for i, band_stats in enumerate(self.stats if self.stats != None else []):
+			if band_stats.count == 0: continue
+			band = self.dataset.GetRasterBand(i + 1)
+			band.SetStatistics(float(band_stats.min), float(band_stats.max), float(band_stats.mean), float(band_stats.std))
+			band.SetMetadataItem('STATISTICS_VALID_PERCENT', '{:.4g}'.format(100.0 * band_stats.count / (self.dataset.RasterXSize * self.dataset.RasterYSize)))
+			hist = band_stats.histogram()
+			if hist != None: band.SetDefaultHistogram(*hist)
+			band = None
+		if self.cog_options != None:
+			gdal.GetDriverByName('COG').CreateCopy(self.out_tif, self.dataset, options = self.cog_options)
+			self.dataset = None
+			gdal.GetDriverByName('GTiff').Delete(self.tmp_tif)
+		self.dataset = None
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def block_writer(out_tif, like, dtype, nodata = None, stats = True, hist = False, profile = None, nband = 1, interleave = 'pixel', descriptions = None, metadata = None, msg = False):
+	"""Open a BlockWriter for an output raster with the same dimensions, geotransform and projection as an existing raster (like)"""
+	num_cols, num_rows, num_bands = get_dims(like)
+	gt, sr = get_gt_sr(like)
+	return BlockWriter(out_tif, num_cols, num_rows, dtype, gt, sr, nodata = nodata, stats = stats, hist = hist, profile = profile, nband = nband, interleave = interleave, descriptions = descriptions, metadata = metadata, msg = msg)
+
+@functools.lru_cache(maxsize = 64)
+def compile_expr(expr):
+	"""Compile a calc() expression string once per process"""
+	return compile(expr, '<calc>', 'eval')
+
+def calc_block(blk, expr, in_nd, nodata = None, np_dtype = None, work_dtype = None):
+	"""Evaluate a calc() expression on one window of named input arrays (blk), applying the nodata mask in_nd = {name: nodata value}"""
+	ind = None
+	for name, nd in in_nd.items():
+		ind = (blk[name] == nd) if ind is None else (ind | (blk[name] == nd))
+	if work_dtype != None:
+		blk = {name: arr.astype(work_dtype) for name, arr in blk.items()}
+	shape = next(iter(blk.values())).shape
+	with np.errstate(all = 'ignore'):
+		res = np.broadcast_to(eval(compile_expr(expr), {'np': np}, blk), shape)
+	res = res.astype(np_dtype) if np_dtype != None else np.array(res)
+	if (ind is not None) and (nodata != None): res[ind] = nodata
+	return res
+
+def calc(expr, inputs, out_tif, dtype, nodata = None, mask = None, work_dtype = None, block_shape = None, workers = 1, mem_budget = MEM_BUDGET, profile = None, stats = True, virtual = False, msg = False):
+	"""Evaluate a band-math expression over named input rasters in one fused, block-by-block pass and write the result to a GeoTIFF.\nexpr is a numpy expression in terms of the input names (e.g., 'pot - cur' or 'np.where(cons > 0, 0, unr)') and inputs is a dict of {name: raster_file}.\nCells that are nodata in any input named in mask are set to the output nodata value: mask may be a list of names (using each file's nodata value), a dict of {name: nodata value}, or None for all inputs that have a nodata value.\nInputs are cast to work_dtype (e.g., np.int32 to avoid overflow) before evaluation, so no full-size temporaries are ever allocated.\nWindows are processed by run_parallel() with the given number of workers.\nIf virtual = True, nothing is computed: a small virtual layer spec standing in for out_tif is written instead (see virtual_layer() and materialize()), and any existing out_tif is removed."""
+	np_dtype = dtype_numpy(dtype)
+	if np_dtype == None:
+		print('Error: output data type invalid', flush = True)
+		return
+	if mask == None:
+		in_nd = {name: get_nodata(f) for name, f in inputs.items()}
+		in_nd = {name: nd for name, nd in in_nd.items() if nd != None}
+	elif type(mask) == dict:
+		in_nd = mask
+	else:
+		in_nd = {name: get_nodata(inputs[name]) for name in mask}
+	compile_expr(expr) # fail early on syntax errors
+	if virtual:
+		# a GeoTIFF takes precedence over its spec (see virtual_layer()), so remove one left by an earlier run
+		if os.path.exists(out_tif):
+			if msg: print('Removing {}, superseded by its virtual layer ...'.format(out_tif), flush = True)
+			gdal.GetDriverByName('GTiff').Delete(out_tif)
+		write_virtual(expr, inputs, virtual_file(out_tif), dtype, nodata = nodata, in_nd = in_nd, work_dtype = work_dtype, msg = msg)
+		return
+	func = functools.partial(calc_block, expr = expr, in_nd = in_nd, nodata = nodata, np_dtype = np_dtype, work_dtype = work_dtype)
+	outputs = {'out': {'file': out_tif, 'dtype': dtype, 'nodata': nodata, 'profile': profile}}
+	run_parallel(func, inputs, outputs, workers = workers, mem_budget = mem_budget, block_shape = block_shape, stats = stats, msg = msg)
+	return
+
+# -----------------------------------------------------------------
+# virtual layers
+# -----------------------------------------------------------------
+
+def virtual_file(out_tif):
+	"""Get the path of the virtual layer spec standing in for a GeoTIFF (e.g., x.tif -> x.vrl.json)"""
+	return os.path.splitext(out_tif)[0] + VIRTUAL_EXT
+
+def virtual_layer(raster_file):
+	"""Get the virtual layer spec to read for a raster file: the file itself if it is a spec, or its spec (see virtual_file()) if the GeoTIFF does not exist, otherwise None"""
+	if raster_file.endswith(VIRTUAL_EXT): return raster_file
+	if os.path.exists(raster_file): return
+	vf = virtual_file(raster_file)
+	return vf if os.path.exists(vf) else None
+
+def write_virtual(expr, inputs, out_file, dtype, nodata = None, in_nd = None, work_dtype = None, msg = False):
+	"""Write a virtual layer spec: a small JSON file with a calc() expression over named input rasters (or other virtual layers), which readers evaluate block-by-block on the fly.\nInput paths are stored relative to the spec's directory."""
+	spec_dir = os.path.dirname(os.path.abspath(out_file))
+	spec = {
+		'expr': expr,
+		'inputs': {name: os.path.relpath(os.path.abspath(f), spec_dir) for name, f in inputs.items()},
+		'dtype': dtype,
+		'nodata': nodata,
+		'mask': {} if in_nd == None else in_nd,
+		'work_dtype': None if work_dtype == None else np.dtype(work_dtype).name
+	}
+	with open(out_file, 'w') as f:
+		json.dump(spec, f, indent = 1)
+	if msg: print('Created virtual layer {}'.format(out_file), flush = True)
+	return
+
+def read_virtual(virtual_file):
+	"""Get the spec of a virtual layer as a dict, with input paths resolved (cached until the file changes on disk)"""
+	st = os.stat(virtual_file)
+	return _read_virtual(os.path.abspath(virtual_file), st.st_mtime_ns)
+
+@functools.lru_cache(maxsize = 256)
+def _read_virtual(path, mtime):
+	with open(path) as f:
+		spec = json.load(f)
+	spec['inputs'] = {name: os.path.join(os.path.dirname(path), f) for name, f in spec['inputs'].items()}
+	return spec
+
+def read_virtual_window(virtual_file, row_off, col_off, nrows, ncols, buffers = None):
+	"""Evaluate a window of a virtual layer, reading its inputs with read_input() (into reused buffers from the buffers dict, if given)"""
+	spec = read_virtual(virtual_file)
+	blk = {}
+	for name, f in spec['inputs'].items():
+		blk[name] = read_input(f, row_off, col_off, nrows, ncols, bands = 1, buffers = None if buffers == None else buffers.setdefault((virtual_file, name), {}))
+	return calc_block(blk, spec['expr'], spec['mask'], nodata = spec['nodata'], np_dtype = dtype_numpy(spec['dtype']), work_dtype = spec['work_dtype'])
+
+def materialize(virtual_file, out_tif = None, workers = None, mem_budget = MEM_BUDGET, block_shape = None, profile = None, stats = True, msg = False):
+	"""Evaluate a virtual layer into a GeoTIFF (by default, the GeoTIFF it stands in for, e.g., x.vrl.json -> x.tif) and return its path"""
+	spec = read_virtual(virtual_file)
+	if out_tif == None: out_tif = virtual_file[:-len(VIRTUAL_EXT)] + '.tif'
+	calc(spec['expr'], spec['inputs'], out_tif, spec['dtype'], nodata = spec['nodata'], mask = spec['mask'], work_dtype = spec['work_dtype'], block_shape = block_shape, workers = workers, mem_budget = mem_budget, profile = profile, stats = stats, msg = msg)
+	return out_tif
+
+# -----------------------------------------------------------------
+# parallel block executor
+# -----------------------------------------------------------------
+
+# per-process state of run_parallel() workers
+_worker = {}
+
+def _init_worker(func, inputs, with_window = False, out_stats = None):
+	_worker['func'] = func
+	_worker['inputs'] = inputs
+	_worker['with_window'] = with_window
+	_worker['out_stats'] = out_stats
+	_worker['buffers'] = {}
+
+def _input_file_bands(spec):
+	# run_parallel() inputs are either a raster file (band 1) or a (raster file, bands) tuple
+	return spec if type(spec) == tuple else (spec, 1)
+
+def _run_window(window):
+	row_off, col_off, nrows, ncols = window
+	blk = {}
+	for name, spec in _worker['inputs'].items():
+		f, bands = _input_file_bands(spec)
+		blk[name] = read_input(f, row_off, col_off, nrows, ncols, bands = bands, buffers = _worker['buffers'].setdefault(name, {}))
+	res = _worker['func'](blk, window) if _worker['with_window'] else _worker['func'](blk)
+	if _worker['out_stats'] == None: return [res, None]
+	return [res, _window_stats(res, _worker['out_stats'])]
+
+def _window_stats(res, out_stats):
+	# RunningStats of each band of each output of one window, computed in the worker and merged by the writer
+	out = res[0] if type(res) == tuple else res
+	if type(out) != dict: out = {name: out for name in out_stats}
+	win_stats = {}
+	for name, bands in out_stats.items():
+		arr = out[name]
+		arrs = [arr[i] for i in range(arr.shape[0])] if arr.ndim == 3 else [arr]
+		win_stats[name] = []
+		for arr_band, (nd, hist, dtype) in zip(arrs, bands):
+			rs = RunningStats(nodata = nd, hist = hist)
+			rs.update(arr_band, dtype = dtype)
+			win_stats[name].append(rs)
+	return win_stats
+
+def merge_metrics(total, part):
+	"""Merge a dict of per-window metrics into a running total (in place): RunningStats (and other objects with a merge() method) are merged, numbers and numpy arrays are added, and lists are concatenated"""
+	for key, value in part.items():
+		if key not in total:
+			total[key] = value
+		elif hasattr(total[key], 'merge'):
+			total[key].merge(value)
+		else:
+			total[key] = total[key] + value
+	return total
+
+def parallel_windows(inputs, outputs, workers, mem_budget = MEM_BUDGET, block_shape = None):
+	"""List windows for run_parallel(), sized so that the windows in flight across all workers fit within mem_budget bytes"""
+	files = [_input_file_bands(spec)[0] for spec in inputs.values()]
+	if block_shape != None:
+		return block_windows(files[0], block_shape = block_shape)
+	bytes_per_px = 0
+	for spec in inputs.values():
+		f, bands = _input_file_bands(spec)
+		nband = get_nbands(f) if bands == None else (1 if type(bands) == int else len(bands))
+		bytes_per_px += nband * dtype_bit_depth(get_dtype(f)) // 8
+	bytes_per_px += sum(spec.get('nband', 1) * dtype_bit_depth(spec['dtype']) // 8 for spec in outputs.values())
+	# each window in flight holds its inputs, outputs and block-sized temporaries,
+	# and up to two windows per worker are in flight (one computing, one queued for writing)
+	max_pixels = mem_budget // (2 * workers * TEMP_FACTOR * max(1, bytes_per_px))
+	return block_windows(files[0], max_pixels = max(1, max_pixels))
+
+def run_parallel(func, inputs, outputs, workers = None, mem_budget = MEM_BUDGET, block_shape = None, windows = None, callback = None, with_window = False, stats = True, msg = False):
+	"""Apply a per-pixel function to disjoint windows of named input rasters in a process pool, writing results through a single ordered writer.\nfunc(blk) takes a dict of {name: array} for one window and returns a dict of {name: array} (or a single array if there is only one output); input arrays are reused between windows, so func must not keep references to them.\nfunc may also return an (outputs, metrics) tuple, where metrics is a dict of per-window numbers, numpy arrays or RunningStats: these are merged in window order (see merge_metrics()) and returned.\ninputs is a dict of {name: raster_file} (band 1 is read) or {name: (raster_file, bands)} (see raster() for bands).\noutputs is a dict of {name: {'file': out_tif, 'dtype': dtype, 'nodata': nodata[, 'hist': True, 'profile': profile, 'nband': n, 'interleave': 'pixel', 'descriptions': [...], 'metadata': {...}]}}, created like the first input; multi-band outputs take 3D (band, row, col) arrays.\nUnless block_shape is given, the window size is chosen from mem_budget (bytes, across all workers); windows may also list the [row_off, col_off, nrows, ncols] windows to process (outputs then only cover those windows).\nIf given, callback(window, metrics) is called in this process for every window, in window order. If with_window = True, func is called as func(blk, window). workers = None uses all CPUs; workers = 1 runs in this process."""
+	if workers == None: workers = os.cpu_count()
+	files = [_input_file_bands(spec)[0] for spec in inputs.values()]
+	dims = [get_dims(f)[0:2] for f in files]
+	if any(d != dims[0] for d in dims):
+		print('Error: input rasters must have the same dimensions.', flush = True)
+		return
+	if windows == None: windows = parallel_windows(inputs, outputs, workers, mem_budget = mem_budget, block_shape = block_shape)
+	if msg: print('Processing {} windows using {} worker(s) ...'.format(len(windows), workers), flush = True)
+	writers = {name: block_writer(spec['file'], like = files[0], dtype = spec['dtype'], nodata = spec.get('nodata'), stats = stats, hist = spec.get('hist', False), profile = spec.get('profile'), nband = spec.get('nband', 1), interleave = spec.get('interleave', 'pixel'), descriptions = spec.get('descriptions'), metadata = spec.get('metadata'), msg = msg) for name, spec in outputs.items()}
+	
+	metrics = {}
+	
+	# output statistics are computed per window by the workers and merged here in window order
+	out_stats = {name: [(rs.nodata, rs.hist, writer.dtype) for rs in writer.stats] for name, writer in writers.items()} if stats else None
+	
+	def write_result(window, res_stats):
+		res, win_stats = res_stats
+		if type(res) == tuple:
+			res, res_metrics = res
+			if callback != None: callback(window, res_metrics)
+			merge_metrics(metrics, res_metrics)
+		if type(res) != dict: res = {name: res for name in outputs}
+		for name, writer in writers.items():
+			writer.write(res[name], window[0], window[1], update_stats = False)
+			if win_stats != None: writer.merge_stats(win_stats[name])
+	
+	try:
+		if workers == 1:
+			_init_worker(func, inputs, with_window, out_stats)
+			for window in windows:
+				write_result(window, _run_window(window))
+		else:
+			# fork (where available) so that func does not need to be picklable
+			ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+			with ctx.Pool(workers, initializer = _init_worker, initargs = (func, inputs, with_window, out_stats)) as pool:
+				pending = collections.deque()
+				for window in windows:
+					pending.append((window, pool.apply_async(_run_window, (window,))))
+					if len(pending) >= 2 * workers:
+						window_done, res = pending.popleft()
+						write_result(window_done, res.get())
+				while pending:
+					window_done, res = pending.popleft()
+					write_result(window_done, res.get())
+	finally:
+		for writer in writers.values(): writer.close()
+	return metrics
+
+def write_gtiff(img_arr, out_tif, dtype, gt, sr, nodata = None, stats = True, hist = False, profile = None, interleave = 'pixel', descriptions = None, msg = False):
+	"""Write a 2D numpy image array, or a 3D (band, row, col) array as a multi-band raster, to a GeoTIFF raster file on disk, with statistics (and optionally a histogram) computed in-process.\nprofile is a named set of creation options (see GTIFF_PROFILES), defaulting to GTIFF_PROFILE.\nMulti-band rasters are 'pixel' or 'band' interleaved; nodata and descriptions may be given per band as lists."""
 	
 	# check that output is a numpy array
 	if type(img_arr) != np.ndarray:
@@ -158,44 +882,45 @@ def write_gtiff(img_arr, out_tif, dtype, gt, sr, nodata = None, stats = True, ms
 		print('Error: output data type invalid', flush = True)
 		return
 	
-	if msg: print('Writing {} ...'.format(out_tif), flush = True)
-	ndim = img_arr.ndim
-	nband = 1
-	nrow = img_arr.shape[0]
-	ncol = img_arr.shape[1]
-	driver = gdal.GetDriverByName('GTiff')
-	out_dataset = driver.Create(out_tif, ncol, nrow, nband, dtype_int, options = [ 'COMPRESS=LZW' ])
-	out_dataset.SetGeoTransform(gt)
-	out_dataset.SetProjection(sr)
-	out_dataset.GetRasterBand(1).WriteArray(img_arr)
-	if (nodata != None) and (type(nodata) != str):
-		out_dataset.GetRasterBand(1).SetNoDataValue(nodata)
-	out_dataset = None
-	if stats: cmd_chk = sp.run(['gdal_edit.py', '-stats', out_tif])
+	nband = img_arr.shape[0] if img_arr.ndim == 3 else 1
+	nrow = img_arr.shape[-2]
+	ncol = img_arr.shape[-1]
+	with BlockWriter(out_tif, ncol, nrow, dtype, gt, sr, nodata = nodata, stats = stats, hist = hist, profile = profile, nband = nband, interleave = interleave, descriptions = descriptions, msg = msg) as out:
+		out.write(img_arr)
 	return
 
+def stream_stats(raster_file, band = 1, where = None, hist = False, block_shape = None):
+	"""Get a RunningStats of the valid cells of a raster band in one block-streaming pass.\nwhere optionally restricts the cells used: an expression string in terms of x (the raster values), e.g. 'x > 0', or a function of the array."""
+	rs = RunningStats(nodata = get_nodata(raster_file, band), hist = hist)
+	for row_off, col_off, arrs in iter_blocks(raster_file, block_shape = block_shape, bands = band, reuse = True):
+		arr = arrs[0]
+		if where != None:
+			if type(where) == str:
+				with np.errstate(all = 'ignore'):
+					ind = eval(compile_expr(where), {'np': np}, {'x': arr})
+			else:
+				ind = where(arr)
+			arr = arr[ind]
+		rs.update(arr)
+	return rs
+
+def quantile(raster_file, q, where = None, band = 1, block_shape = None):
+	"""Get the q-th quantile(s) (0 <= q <= 1, as in np.quantile) of the valid cells of a raster in one block-streaming pass, without materialising the valid-cell vector.\nwhere optionally restricts the cells used (see stream_stats()), e.g., quantile(f, 0.9999, where = 'x > 0').\nQuantiles are exact for 8- and 16-bit integer rasters and approximate (relative accuracy SKETCH_ACCURACY) otherwise."""
+	rs = stream_stats(raster_file, band = band, where = where, hist = True, block_shape = block_shape)
+	return rs.quantile(q)
+
 def stats(input, nodata = None):
-	"""Get descriptive statistics for either a raster on disk (input = filepath) or a numpy array stored in memory"""
+	"""Get descriptive statistics for either a raster on disk (input = filepath, streamed block-by-block in one pass) or a numpy array stored in memory"""
 	if (type(input) != str) and (type(input) != np.ndarray):
 		print("Error: input must be either filepath to raster or numpy image array.", flush = True)
 		return
 	elif type(input) == str:
-		file = gdal.Open(input)
-		img = np.array(file.GetRasterBand(1).ReadAsArray())
-		nodata = file.GetRasterBand(1).GetNoDataValue()
-		img_data = img[img != nodata]
-		del img
-		img_min = np.min(img_data)
-		img_max = np.max(img_data)
-		img_mean = np.mean(img_data)
-		img_std = np.std(img_data)
-		file = None
+		rs = stream_stats(input)
+		nodata = rs.nodata
 	else: # type(input) == np.ndarray
-		if nodata != None: input = input[input != nodata]
-		img_min = np.min(input)
-		img_max = np.max(input)
-		img_mean = np.mean(input)
-		img_std = np.std(input)
+		rs = RunningStats(nodata = nodata)
+		rs.update(input)
+	img_min, img_max, img_mean, img_std = rs.min, rs.max, rs.mean, rs.std
 	if nodata == None:
 		print("Min.\tMax.\tMean\tStd.", flush = True)
 		print("%2.2f\t%2.2f\t%2.2f\t%2.2f" % (img_min, img_max, img_mean, img_std), flush = True)
@@ -206,3 +931,468 @@ def stats(input, nodata = None):
 		return
 
 
+# -----------------------------------------------------------------
+# bit-packed masks
+# -----------------------------------------------------------------
+
+# dataset metadata item listing the plane names of a packed mask raster (bit 0 first)
+MASK_PLANES_KEY = 'RASPY_MASK_PLANES'
+
+def pack_bits(masks):
+	"""Pack a list of boolean arrays of the same shape into one uint8 (up to 8 masks) or uint16 (up to 16 masks) array, with mask i in bit i"""
+	if len(masks) > 16:
+		print('Error: at most 16 masks can be packed.', flush = True)
+		return
+	dtype = np.uint8 if len(masks) <= 8 else np.uint16
+	packed = np.zeros(np.shape(masks[0]), dtype = dtype)
+	for i, m in enumerate(masks):
+		packed |= (np.asarray(m, dtype = bool).astype(dtype) << dtype(i))
+	return packed
+
+def unpack_bits(packed, plane):
+	"""Get the boolean array of one bit plane (int) of a packed mask array, or a 3D (plane, row, col) stack for a list of planes"""
+	if type(plane) == list: return np.stack([unpack_bits(packed, p) for p in plane])
+	return (packed & packed.dtype.type(1 << plane)) != 0
+
+def plane_bits(planes, names):
+	"""Get the integer with the bits of the named planes set, e.g., (packed & plane_bits(planes, ['crop', 'past'])) != 0 is 'any of crop or pasture'"""
+	return sum(1 << planes.index(name) for name in names)
+
+def mask_planes(mask_file):
+	"""Get the list of plane names of a packed mask raster (see pack_masks())"""
+	planes = open_dataset(mask_file).GetMetadataItem(MASK_PLANES_KEY)
+	return planes.split(',') if planes else []
+
+def eval_mask(packed, planes, expr):
+	"""Evaluate a boolean predicate over the named planes of one window of a packed mask array, e.g., 'crop | shift' or '~urbn & past'.\nOnly the planes used in the expression are unpacked, and 'any' is true where any plane is set."""
+	code = compile_expr(expr)
+	ns = {name: unpack_bits(packed, planes.index(name)) for name in code.co_names if name in planes}
+	ns['any'] = packed != 0
+	return eval(code, {'np': np}, ns)
+
+def _pack_block(blk, planes):
+	masks = []
+	with np.errstate(all = 'ignore'):
+		for expr in planes.values():
+			masks.append(eval(compile_expr(expr), {'np': np}, blk))
+	return pack_bits(masks)
+
+def pack_masks(inputs, planes, out_tif, workers = None, mem_budget = MEM_BUDGET, block_shape = None, profile = None, msg = False):
+	"""Build a packed mask raster (Byte for up to 8 planes, UInt16 for up to 16) from boolean expressions over named input rasters, in one block-streamed pass.\nplanes is an ordered dict of {plane name: expression} (e.g., {'crop': 'crop == 1', 'urbn': 'urbn == 1'}), stored as bits 0, 1, ... with the plane names in the raster metadata."""
+	if len(planes) > 16:
+		print('Error: at most 16 planes can be packed.', flush = True)
+		return
+	for expr in planes.values(): compile_expr(expr) # fail early on syntax errors
+	outputs = {'mask': {'file': out_tif, 'dtype': 'Byte' if len(planes) <= 8 else 'UInt16', 'nodata': None, 'profile': profile, 'metadata': {MASK_PLANES_KEY: ','.join(planes)}}}
+	run_parallel(functools.partial(_pack_block, planes = planes), inputs, outputs, workers = workers, mem_budget = mem_budget, block_shape = block_shape, stats = False, msg = msg)
+	return
+
+# -----------------------------------------------------------------
+# current/potential harmonisation
+# -----------------------------------------------------------------
+
+def _harmonize_nodata(blk, nd_in, nd_out):
+	# cells that are nodata (input or output code) in either the current or the potential layer
+	m = (blk['cur'] == nd_in) | (blk['pot'] == nd_in)
+	if nd_out != nd_in: m |= (blk['cur'] == nd_out) | (blk['pot'] == nd_out)
+	return m
+
+def _harmonize_pot_stats(blk, nd_in, nd_out):
+	# per-window distribution of positive potential values on cells valid in both layers
+	pot = blk['pot']
+	rs = RunningStats(hist = True)
+	rs.update(pot[~_harmonize_nodata(blk, nd_in, nd_out) & (pot > 0)])
+	return {}, {'pot': rs}
+
+def harmonize_block(blk, nd_in, nd_out, cap = None):
+	"""Harmonise one window of current and potential carbon layers (blk = {'cur': array, 'pot': array, 'lwp': array}):\nnodata cells of either layer are aligned and set to 0, both layers are capped at cap (truncated to the layer data type, as numpy assignment does),\npotential is raised to current where current > potential, and water cells (IGBP land/water probability 0-75 or 255 fill) are set to nd_out"""
+	cur = blk['cur']
+	pot = blk['pot']
+	m = _harmonize_nodata(blk, nd_in, nd_out)
+	if cap != None:
+		cur = np.where(cur > cap, np.array(cap).astype(cur.dtype), cur)
+		pot = np.where(pot > cap, np.array(cap).astype(pot.dtype), pot)
+	pot = np.maximum(pot, cur)
+	cur = np.where(m, 0, cur).astype(blk['cur'].dtype)
+	pot = np.where(m, 0, pot).astype(blk['pot'].dtype)
+	water = (blk['lwp'] <= 75) | (blk['lwp'] == 255)
+	cur[water] = nd_out
+	pot[water] = nd_out
+	return {'cur': cur, 'pot': pot}
+
+def harmonize(f_cur, f_pot, f_lwp, out_cur, out_pot, nd_in = -32768, nd_out = -32768, cap = None, cap_pct = None, dtype = 'Int16', workers = None, mem_budget = MEM_BUDGET, block_shape = None, profile = None, msg = False):
+	"""Harmonise a pair of current and potential carbon density rasters with a land/water probability raster (see harmonize_block()) in one block-streamed pass, writing both outputs.\nThe outlier cap is either a value (cap) or the cap_pct-th percentile (0-100, as in np.percentile) of the positive potential values on cells valid in both layers, which is computed exactly in one extra streaming pass.\nReturns the cap used."""
+	inputs = {'cur': f_cur, 'pot': f_pot, 'lwp': f_lwp}
+	if (cap == None) and (cap_pct != None):
+		metrics = run_parallel(functools.partial(_harmonize_pot_stats, nd_in = nd_in, nd_out = nd_out), inputs = {'cur': f_cur, 'pot': f_pot}, outputs = {}, workers = workers, mem_budget = mem_budget, block_shape = block_shape, msg = msg)
+		if metrics == None: return
+		cap = metrics['pot'].quantile(cap_pct / 100)
+		if msg: print('Potential {}th percentile (cap): {}'.format(cap_pct, cap), flush = True)
+	func = functools.partial(harmonize_block, nd_in = nd_in, nd_out = nd_out, cap = cap)
+	outputs = {'cur': {'file': out_cur, 'dtype': dtype, 'nodata': nd_out, 'profile': profile},
+		'pot': {'file': out_pot, 'dtype': dtype, 'nodata': nd_out, 'profile': profile}}
+	run_parallel(func, inputs, outputs, workers = workers, mem_budget = mem_budget, block_shape = block_shape, msg = msg)
+	return cap
+
+# -----------------------------------------------------------------
+# zonal statistics
+# -----------------------------------------------------------------
+
+def zone_digits(raster_file):
+	"""Get [offset, radix] of the mixed-radix digit of an integer zone raster in a packed zone key: digit = value - offset (0 = nodata), radix = data type range + 1"""
+	np_dtype = dtype_numpy(get_dtype(raster_file))
+	if (np_dtype == None) or (np.dtype(np_dtype).kind not in 'iu'):
+		print('Error: zone raster {} must have an integer data type.'.format(raster_file), flush = True)
+		return
+	iinfo = np.iinfo(np_dtype)
+	return [int(iinfo.min) - 1, int(iinfo.max) - int(iinfo.min) + 2]
+
+def zone_keys(zones, digits, nodata):
+	"""Pack one window of zone arrays into int64 mixed-radix keys, the first zone being the least significant digit (see zone_digits()); nodata cells of a zone get digit 0"""
+	if np.prod([float(radix) for offset, radix in digits]) >= 2**63:
+		print('Error: too many or too large zone rasters to pack into 64-bit keys.', flush = True)
+		return
+	keys = np.zeros(np.shape(zones[0]), dtype = np.int64)
+	mult = 1
+	for arr, (offset, radix), nd in zip(zones, digits, nodata):
+		d = arr.astype(np.int64) - offset
+		if nd != None: d[arr == nd] = 0
+		keys += d * mult
+		mult *= radix
+	return keys
+
+def unpack_zone_keys(keys, digits):
+	"""Decode packed zone keys into one float64 array of zone codes per zone (NaN = nodata)"""
+	codes = []
+	for offset, radix in digits:
+		d = keys % radix
+		keys = keys // radix
+		codes.append(np.where(d == 0, np.nan, (d + offset).astype(np.float64)))
+	return codes
+
+def _segments(keys):
+	# stable sort order, unique keys and start of each run of equal keys, for segmented reductions
+	order = np.argsort(keys, kind = 'stable')
+	sk = keys[order]
+	starts = np.flatnonzero(np.concatenate(([True], sk[1:] != sk[:-1]))) if sk.size else np.zeros(0, dtype = np.intp)
+	return [order, sk[starts], starts]
+
+class ZonalStats(object):
+	"""Mergeable partial aggregates of named variables by zone, seen block-by-block: for each packed zone key (see zone_keys()), the number of cells and, per variable, the number of valid (non-nodata, non-NaN) cells, their sum and their sum of squares.\nInteger variables are accumulated in int64 (exact), others in float64 in a fixed (stable-sorted) order, so merging the partials of the same windows in window order always gives bit-identical results.\nPartials are stored as .npz files with save() and load_zonal()."""
+	
+	def __init__(self, names, nodata = None):
+		self.names = list(names)
+		self.nodata = nodata if nodata != None else {}
+		self.keys = np.zeros(0, dtype = np.int64)
+		self.count = np.zeros(0, dtype = np.int64)
+		self.n = {}
+		self.sum = {}
+		self.sumsq = {}
+	
+	def update(self, keys, values):
+		"""Add one window of packed zone keys and a dict of {name: array} of the same shape"""
+		keys = keys.ravel()
+		if keys.size == 0: return
+		order, ukeys, starts = _segments(keys)
+		count = np.diff(np.append(starts, keys.size))
+		n = {}
+		sums = {}
+		sumsqs = {}
+		for name in self.names:
+			arr = values[name].ravel()[order]
+			acc = np.int64 if arr.dtype.kind in 'iub' else np.float64
+			invalid = np.zeros(arr.shape, dtype = bool)
+			nd = self.nodata.get(name)
+			if nd != None: invalid |= (arr == nd)
+			if acc == np.float64: invalid |= np.isnan(arr)
+			vals = arr.astype(acc)
+			vals[invalid] = 0
+			n[name] = np.add.reduceat((~invalid).astype(np.int64), starts)
+			sums[name] = np.add.reduceat(vals, starts)
+			sumsqs[name] = np.add.reduceat(vals * vals, starts)
+		self._merge(ukeys, count, n, sums, sumsqs)
+	
+	def merge(self, other):
+		"""Merge the aggregates of another ZonalStats (of the same variables) into this one"""
+		self._merge(other.keys, other.count, other.n, other.sum, other.sumsq)
+	
+	def _merge(self, keys, count, n, sums, sumsqs):
+		if keys.size == 0: return
+		if self.keys.size == 0:
+			self.keys, self.count, self.n, self.sum, self.sumsq = keys, count, dict(n), dict(sums), dict(sumsqs)
+			return
+		order, ukeys, starts = _segments(np.concatenate((self.keys, keys)))
+		reduce = lambda a, b: np.add.reduceat(np.concatenate((a, b))[order], starts)
+		self.count = reduce(self.count, count)
+		for name in self.names:
+			self.n[name] = reduce(self.n[name], n[name])
+			self.sum[name] = reduce(self.sum[name], sums[name])
+			self.sumsq[name] = reduce(self.sumsq[name], sumsqs[name])
+		self.keys = ukeys
+	
+	def mean(self, name):
+		"""Mean of the valid cells of a variable per zone (NaN where there are none)"""
+		with np.errstate(all = 'ignore'):
+			return self.sum[name] / self.n[name]
+	
+	def std(self, name):
+		"""Population standard deviation of the valid cells of a variable per zone"""
+		with np.errstate(all = 'ignore'):
+			return np.sqrt(np.maximum(self.sumsq[name] / self.n[name] - np.square(self.mean(name)), 0))
+	
+	def select(self, names):
+		"""Get a ZonalStats of only the named variables (sharing this one's arrays)"""
+		zs = ZonalStats(names, nodata = {name: self.nodata.get(name) for name in names})
+		zs.keys, zs.count = self.keys, self.count
+		for name in names:
+			if name in self.sum: zs.n[name], zs.sum[name], zs.sumsq[name] = self.n[name], self.sum[name], self.sumsq[name]
+		return zs
+	
+	def save(self, path):
+		"""Write the aggregates to an .npz file (atomically, via a temporary file)"""
+		arrays = {'names': np.array(self.names), 'keys': self.keys, 'count': self.count}
+		for i, name in enumerate(self.names):
+			arrays['n{}'.format(i)] = self.n.get(name, np.zeros(0, dtype = np.int64))
+			arrays['sum{}'.format(i)] = self.sum.get(name, np.zeros(0))
+			arrays['sumsq{}'.format(i)] = self.sumsq.get(name, np.zeros(0))
+		tmp = '{}.{}.tmp.npz'.format(path, os.getpid())
+		np.savez(tmp, **arrays)
+		os.replace(tmp, path)
+
+def load_zonal(path):
+	"""Read a ZonalStats written by ZonalStats.save()"""
+	with np.load(path) as f:
+		zs = ZonalStats(f['names'].tolist())
+		zs.keys = f['keys']
+		zs.count = f['count']
+		if zs.keys.size:
+			for i, name in enumerate(zs.names):
+				zs.n[name] = f['n{}'.format(i)]
+				zs.sum[name] = f['sum{}'.format(i)]
+				zs.sumsq[name] = f['sumsq{}'.format(i)]
+	return zs
+
+def join_zonal(parts):
+	"""Join ZonalStats of different variables over the same window (and so the same zone keys) into one"""
+	zs = ZonalStats([name for part in parts for name in part.names])
+	zs.keys, zs.count = parts[0].keys, parts[0].count
+	for part in parts:
+		if not np.array_equal(part.keys, zs.keys):
+			raise ValueError('cannot join zonal aggregates of different zone keys')
+		zs.n.update(part.n)
+		zs.sum.update(part.sum)
+		zs.sumsq.update(part.sumsq)
+	return zs
+
+def _zonal_block(blk, zone_vars, digits, zone_nd, var_nd):
+	keys = zone_keys([blk[v] for v in zone_vars], digits, [zone_nd[v] for v in zone_vars])
+	zs = ZonalStats(list(var_nd), nodata = var_nd)
+	zs.update(keys, blk)
+	return {}, {'zonal': zs}
+
+def zonal_windows(zones, block_shape = None, max_pixels = BLOCK_PIXELS // 16):
+	"""List the windows of a zonal run: they depend only on the first zone raster (not on the number of workers or nodes), so that results are bit-identical however the work is split"""
+	return block_windows(next(iter(zones.values())), block_shape = block_shape, max_pixels = max_pixels)
+
+def run_zonal(zones, variables, workers = None, block_shape = None, max_pixels = BLOCK_PIXELS // 16, partial_dir = None, node = 0, nodes = 1, msg = False):
+	"""Aggregate variables by combined zones (see ZonalStats) in one block-streamed pass, fanning windows out across a process pool.\nzones and variables are ordered dicts of {name: raster_file}; returns [ZonalStats, zone key digits].\nIf partial_dir (e.g., a directory shared by several nodes) is given, each window's partial aggregate is also written there, and only this node's share of the windows (node of nodes, in contiguous ranges) is computed;\nwindows already in partial_dir are skipped, and reduce_zonal() merges all partials once every node is done. The returned ZonalStats then only covers this node's windows."""
+	digits = [zone_digits(f) for f in zones.values()]
+	if any(d == None for d in digits): return
+	zone_nd = {name: get_nodata(f) for name, f in zones.items()}
+	var_nd = collections.OrderedDict((name, get_nodata(f)) for name, f in variables.items())
+	inputs = collections.OrderedDict(list(zones.items()) + list(variables.items()))
+	windows = zonal_windows(zones, block_shape = block_shape, max_pixels = max_pixels)
+	func = functools.partial(_zonal_block, zone_vars = list(zones), digits = digits, zone_nd = zone_nd, var_nd = var_nd)
+	if partial_dir == None:
+		metrics = run_parallel(func, inputs, outputs = {}, workers = workers, windows = windows, msg = msg)
+		return [metrics.get('zonal', ZonalStats(list(variables))), digits]
+	
+	# the manifest identifies the run, so that partials of different inputs or windows are never mixed
+	os.makedirs(partial_dir, exist_ok = True)
+	manifest = {'zones': zones, 'variables': variables, 'digits': digits, 'windows': windows}
+	f_manifest = os.path.join(partial_dir, 'zonal.json')
+	if os.path.exists(f_manifest):
+		with open(f_manifest) as f:
+			if json.load(f) != json.loads(json.dumps(manifest)):
+				print('Error: {} holds partials of a different zonal run.'.format(partial_dir), flush = True)
+				return
+	else:
+		tmp = '{}.{}.tmp'.format(f_manifest, os.getpid())
+		with open(tmp, 'w') as f: json.dump(manifest, f, indent = 1)
+		os.replace(tmp, f_manifest)
+	
+	index = {tuple(w): i for i, w in enumerate(windows)}
+	partial = lambda i: os.path.join(partial_dir, 'zonal_{:06d}.npz'.format(i))
+	share = range(node * len(windows) // nodes, (node + 1) * len(windows) // nodes)
+	todo = [windows[i] for i in share if not os.path.exists(partial(i))]
+	if msg: print('Node {} of {}: {} of {} windows left to compute ...'.format(node + 1, nodes, len(todo), len(share)), flush = True)
+	callback = lambda window, metrics: metrics['zonal'].save(partial(index[tuple(window)]))
+	metrics = run_parallel(func, inputs, outputs = {}, workers = workers, windows = todo, callback = callback, msg = msg) if todo else {}
+	return [metrics.get('zonal', ZonalStats(list(variables))), digits]
+
+def reduce_zonal(partial_dir, msg = False):
+	"""Merge all per-window partial aggregates of a zonal run in partial_dir (see run_zonal()) in window order, returning [ZonalStats, zone key digits]"""
+	with open(os.path.join(partial_dir, 'zonal.json')) as f:
+		manifest = json.load(f)
+	partials = [os.path.join(partial_dir, 'zonal_{:06d}.npz'.format(i)) for i in range(len(manifest['windows']))]
+	missing = [p for p in partials if not os.path.exists(p)]
+	if missing:
+		print('Error: {} of {} partials missing in {}.'.format(len(missing), len(partials), partial_dir), flush = True)
+		return
+	if msg: print('Merging {} partials ...'.format(len(partials)), flush = True)
+	zs = ZonalStats(list(manifest['variables']))
+	for p in partials: zs.merge(load_zonal(p))
+	return [zs, manifest['digits']]
+
+def layer_fingerprint(raster_file):
+	"""Get a fingerprint (sha1 hex digest) of a raster that changes whenever its data may have changed: its path, mtime and size, or for virtual layers, the spec and the fingerprints of its inputs"""
+	vf = virtual_layer(raster_file)
+	if vf != None:
+		spec = dict(read_virtual(vf))
+		spec['inputs'] = {name: layer_fingerprint(f) for name, f in spec['inputs'].items()}
+		key = json.dumps(spec, sort_keys = True)
+	else:
+		st = os.stat(raster_file)
+		key = '{}|{}|{}'.format(os.path.abspath(raster_file), st.st_mtime_ns, st.st_size)
+	return hashlib.sha1(key.encode()).hexdigest()
+
+def run_zonal_cached(zones, variables, cache_dir, workers = None, block_shape = None, max_pixels = BLOCK_PIXELS // 16, msg = False):
+	"""Aggregate variables by combined zones like run_zonal(), keeping per-variable, per-window partial aggregates in cache_dir, keyed by a fingerprint of the zone layers, the windows and the variable (see layer_fingerprint()).\nOnly variables (and windows) without cached partials are read and computed, so refreshing one layer costs one read of that layer and of the zones; all partials are then merged in window order (bit-identical to an uncached run).\nReturns [ZonalStats, zone key digits]."""
+	digits = [zone_digits(f) for f in zones.values()]
+	if any(d == None for d in digits): return
+	windows = zonal_windows(zones, block_shape = block_shape, max_pixels = max_pixels)
+	zone_key = json.dumps({'zones': [[name, layer_fingerprint(f)] for name, f in zones.items()], 'digits': digits, 'windows': windows})
+	var_dirs = collections.OrderedDict()
+	for name, f in variables.items():
+		fp = hashlib.sha1('{}|{}|{}|{}'.format(zone_key, name, layer_fingerprint(f), get_nodata(f)).encode()).hexdigest()
+		var_dirs[name] = os.path.join(cache_dir, fp)
+	partial = lambda name, i: os.path.join(var_dirs[name], 'zonal_{:06d}.npz'.format(i))
+	
+	# variables with missing partials, and the windows where any of them is missing
+	stale = [name for name in variables if any(not os.path.exists(partial(name, i)) for i in range(len(windows)))]
+	todo = [i for i in range(len(windows)) if any(not os.path.exists(partial(name, i)) for name in stale)]
+	if msg: print('{} of {} variables to (re)compute over {} of {} windows ...'.format(len(stale), len(variables), len(todo), len(windows)), flush = True)
+	if todo:
+		for name in stale: os.makedirs(var_dirs[name], exist_ok = True)
+		zone_nd = {name: get_nodata(f) for name, f in zones.items()}
+		var_nd = collections.OrderedDict((name, get_nodata(variables[name])) for name in stale)
+		inputs = collections.OrderedDict(list(zones.items()) + [(name, variables[name]) for name in stale])
+		func = functools.partial(_zonal_block, zone_vars = list(zones), digits = digits, zone_nd = zone_nd, var_nd = var_nd)
+		index = {tuple(windows[i]): i for i in todo}
+		
+		def save_partials(window, metrics):
+			for name in stale: metrics['zonal'].select([name]).save(partial(name, index[tuple(window)]))
+		
+		run_parallel(func, inputs, outputs = {}, workers = workers, windows = [windows[i] for i in todo], callback = save_partials, msg = msg)
+	
+	if msg: print('Merging {} x {} partials ...'.format(len(windows), len(variables)), flush = True)
+	zs = ZonalStats(list(variables))
+	for i in range(len(windows)):
+		zs.merge(join_zonal([load_zonal(partial(name, i)) for name in variables]))
+	return [zs, digits]
+
+# -----------------------------------------------------------------
+# zone index
+# -----------------------------------------------------------------
+
+# version of the zone index layout, so that indexes built by older versions are rebuilt
+ZONE_INDEX_VERSION = 2
+
+def _index_block(blk, zone_vars, digits, zone_nd):
+	# runs of equal zone keys along the rows of one window, as flat offsets into the window (runs never cross rows; cells outside every zone form runs of key 0)
+	keys = zone_keys([blk[v] for v in zone_vars], digits, [zone_nd[v] for v in zone_vars])
+	flat = keys.ravel()
+	new = np.ones(flat.size, dtype = bool)
+	new[1:] = flat[1:] != flat[:-1]
+	new[::keys.shape[1]] = True
+	starts = np.flatnonzero(new)
+	lengths = np.diff(np.append(starts, flat.size))
+	return {}, {'runs': [(starts.astype(np.int32), lengths.astype(np.int32), flat[starts])]}
+
+def zone_group_codes(keys, digits, group):
+	"""Get the codes of zone number group (0-based, in zone_keys() order) of packed zone keys (int64; digit 0, i.e., nodata, maps to offset)"""
+	radix_prod = 1
+	for offset, radix in digits[:group]: radix_prod *= radix
+	return (keys // radix_prod) % digits[group][1] + digits[group][0]
+
+def build_zone_index(zones, index_dir, group = None, workers = None, max_pixels = BLOCK_PIXELS // 16, msg = False):
+	"""Encode the packed zone key (see zone_keys()) of every cell as runs along the rows of the windows of a zonal run (see zonal_windows()), in one block-streamed pass over the zone rasters, and store them in index_dir:\nruns_start.npy (flat offset into the window), runs_length.npy and runs_key.npy in window order, window_offsets.npy delimiting the runs of each window, plus group_order.npy (numbers of the runs inside at least one zone, ordered by the code of the zone named group, e.g., countries), with group_codes.npy / group_offsets.npy delimiting the runs of each code,\nand zone_index.json (zones, their fingerprints, the key digits and the windows). Summaries of any layer then need only read that layer (see zonal_from_index())."""
+	digits = [zone_digits(f) for f in zones.values()]
+	if any(d == None for d in digits): return
+	windows = zonal_windows(zones, max_pixels = max_pixels)
+	zone_nd = {name: get_nodata(f) for name, f in zones.items()}
+	func = functools.partial(_index_block, zone_vars = list(zones), digits = digits, zone_nd = zone_nd)
+	metrics = run_parallel(func, zones, outputs = {}, workers = workers, windows = windows, msg = msg)
+	runs = metrics.get('runs', [])
+	starts = np.concatenate([r[0] for r in runs]) if runs else np.zeros(0, dtype = np.int32)
+	lengths = np.concatenate([r[1] for r in runs]) if runs else np.zeros(0, dtype = np.int32)
+	keys = np.concatenate([r[2] for r in runs]) if runs else np.zeros(0, dtype = np.int64)
+	window_offsets = np.append(0, np.cumsum([r[0].size for r in runs], dtype = np.int64))
+	
+	# runs inside at least one zone of each code of the group zone, in window order
+	if group == None: group = next(iter(zones))
+	inside = np.flatnonzero(keys != 0)
+	codes = zone_group_codes(keys[inside], digits, list(zones).index(group))
+	order = inside[np.argsort(codes, kind = 'stable')]
+	group_codes, group_first = np.unique(np.sort(codes, kind = 'stable'), return_index = True)
+	group_offsets = np.append(group_first, order.size)
+	
+	os.makedirs(index_dir, exist_ok = True)
+	for name, arr in [('runs_start', starts), ('runs_length', lengths), ('runs_key', keys), ('window_offsets', window_offsets), ('group_order', order), ('group_codes', group_codes), ('group_offsets', group_offsets)]:
+		np.save(os.path.join(index_dir, name + '.npy'), arr)
+	meta = {'version': ZONE_INDEX_VERSION, 'zones': zones, 'fingerprints': {name: layer_fingerprint(f) for name, f in zones.items()}, 'digits': digits, 'group': group, 'windows': windows}
+	with open(os.path.join(index_dir, 'zone_index.json'), 'w') as f:
+		json.dump(meta, f, indent = 1)
+	if msg: print('Indexed {} cells in {} runs ({} {} codes)'.format(int(lengths.sum(dtype = np.int64)), starts.size, group_codes.size, group), flush = True)
+	return
+
+def zone_index_fresh(index_dir, zones, max_pixels = BLOCK_PIXELS // 16):
+	"""Check that a zone index exists, has the current layout and was built from the current versions of the given zone rasters (with the windows of a zonal run of max_pixels)"""
+	f_meta = os.path.join(index_dir, 'zone_index.json')
+	if not os.path.exists(f_meta): return False
+	with open(f_meta) as f:
+		meta = json.load(f)
+	if (meta.get('version') != ZONE_INDEX_VERSION) or (list(meta['zones']) != list(zones)): return False
+	if meta['windows'] != zonal_windows(zones, max_pixels = max_pixels): return False
+	return all(meta['fingerprints'].get(name) == layer_fingerprint(f) for name, f in zones.items())
+
+def _index_sums(blk, window, starts, lengths, keys, var_nd, ranges, sel):
+	# aggregate one window of each variable by the zone keys of its index runs (all of them, or the selected runs sel)
+	i0, i1 = ranges[tuple(window)]
+	zs = ZonalStats(list(var_nd), nodata = var_nd)
+	if sel is None:
+		# the runs of a window cover it in order, so this is exactly the update of a plain zonal run
+		zs.update(np.repeat(np.asarray(keys[i0:i1]), lengths[i0:i1]), blk)
+		return {}, {'zonal': zs}
+	runs = sel[i0:i1]
+	l = np.asarray(lengths[runs], dtype = np.intp)
+	# flat offsets of the cells of the selected runs, in raster order
+	idx = np.repeat(np.asarray(starts[runs], dtype = np.intp) - (np.cumsum(l) - l), l) + np.arange(l.sum())
+	zs.update(np.repeat(np.asarray(keys[runs]), l), {name: blk[name].ravel()[idx] for name in var_nd})
+	return {}, {'zonal': zs}
+
+def zonal_from_index(index_dir, variables, code = None, workers = None, msg = False):
+	"""Aggregate variables (ordered dict of {name: raster_file}) by the zones of a zone index (see build_zone_index()), reading only the variable rasters.\nThe windows and per-window reductions are those of run_zonal(), so the result is bit-identical to a run_zonal() of the indexed zones (cells outside every zone included).\nIf code is given, only the runs of that code of the index's group zone (e.g., one country) are read from the index, and only the windows they fall in from the rasters.\nReturns [ZonalStats, zone key digits]."""
+	with open(os.path.join(index_dir, 'zone_index.json')) as f:
+		meta = json.load(f)
+	load = lambda name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode = 'r')
+	starts, lengths, keys = load('runs_start'), load('runs_length'), load('runs_key')
+	window_offsets = np.asarray(load('window_offsets'))
+	windows = meta['windows']
+	sel = None
+	if code != None:
+		group_codes = load('group_codes')
+		i = int(np.searchsorted(group_codes, code))
+		if (i == group_codes.size) or (group_codes[i] != code):
+			return [ZonalStats(list(variables)), meta['digits']]
+		offsets = load('group_offsets')
+		# run numbers are in window order, so each window's selected runs are contiguous
+		sel = np.asarray(load('group_order')[offsets[i]:offsets[i + 1]])
+		window_offsets = np.searchsorted(sel, window_offsets)
+	ranges = {tuple(w): (int(window_offsets[j]), int(window_offsets[j + 1])) for j, w in enumerate(windows)}
+	windows = [w for w in windows if ranges[tuple(w)][1] > ranges[tuple(w)][0]]
+	if not windows: return [ZonalStats(list(variables)), meta['digits']]
+	var_nd = collections.OrderedDict((name, get_nodata(f)) for name, f in variables.items())
+	func = functools.partial(_index_sums, starts = starts, lengths = lengths, keys = keys, var_nd = var_nd, ranges = ranges, sel = sel)
+	metrics = run_parallel(func, variables, outputs = {}, workers = workers, windows = windows, with_window = True, msg = msg)
+	return [metrics.get('zonal', ZonalStats(list(variables))), meta['digits']]
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# --------------------------------------------------------------------------------------------------
+#
+# 1_zonal_stats.py
+#
+# Command-line tool to compute zonal stats of global carbon density layers
+# (a streaming, single-pass port of 1_zonal_stats.R built on raspy)
+#
+# Usage:
+#   ./1_zonal_stats.py <inputs.csv> <carbon_summary.csv> [options]
+#
+# --------------------------------------------------------------------------------------------------
+
+import argparse
+import sys
+import pandas as pd
+from raspy import *
+
+# ---------------------------------------------------------------------------------------------
+# I/O
+# ---------------------------------------------------------------------------------------------
+
+def argparse_init():
+	p = argparse.ArgumentParser(description = 'Computes a zonal summary of global carbon rasters.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+	p.add_argument('csv_in', help = 'CSV file containing paths to input raster files')
+	p.add_argument('csv_out', help = 'CSV file to save output carbon summary')
+	p.add_argument('--workers', help = 'number of worker processes', default = os.cpu_count(), type = int)
+	p.add_argument('--overwrite', help = 'overwrite output CSV file if it exists', action = 'store_true')
+	p.add_argument('--cache_dir', help = 'directory to keep per-variable, per-window partial aggregates in, so that reruns only recompute variables whose rasters (or zone rasters) changed', default = None)
+	p.add_argument('--index_dir', help = 'directory of the zone index (built from the zone rasters if missing or out of date), so that summaries only read the carbon rasters', default = None)
+	p.add_argument('--country', help = 'summarize only this gadm_code (requires --index_dir)', default = None, type = int)
+	p.add_argument('--partial_dir', help = 'directory (e.g., shared by several nodes) to write per-window partial aggregates to', default = None)
+	p.add_argument('--node', help = 'index of this node (0-based) when splitting the windows across nodes', default = 0, type = int)
+	p.add_argument('--nodes', help = 'number of nodes the windows are split across; with more than one node, run once more with --reduce when all are done', default = 1, type = int)
+	p.add_argument('--reduce', help = 'only merge the partial aggregates in --partial_dir and write the output CSV', action = 'store_true')
+	return p
+
+def check_inputs(df_in, csv_in):
+
+	# check that necessary CSV columns exist
+	col_hdrs = ['variable', 'zonal', 'file', 'pixel_values', 'code_file', 'code_col', 'name_col']
+	for v in col_hdrs:
+		if v not in df_in.columns: sys.exit('Error: column named "{}" not found in {}'.format(v, csv_in))
+
+	# check that input raster files (or virtual layers) and class code name files exist
+	df_codes = df_in[df_in['pixel_values'] == 'codes']
+	missing = [(v, f) for v, f in zip(df_in['variable'], df_in['file']) if not (os.path.exists(f) or virtual_layer(f))]
+	missing += [(v, f) for v, f in zip(df_codes['variable'], df_codes['code_file']) if not os.path.exists(f)]
+	if missing:
+		sys.exit('Error: could not find:' + ''.join('\n  {:>2}. {:<18} {}'.format(i + 1, v, f) for i, (v, f) in enumerate(missing)))
+
+# ---------------------------------------------------------------------------------------------
+# Build table
+# ---------------------------------------------------------------------------------------------
+
+def summary_table(zs, zone_vars, digits, px_ha):
+	"""Zone codes and carbon totals (Mg) per combined zone"""
+	df = pd.DataFrame(collections.OrderedDict(zip(zone_vars, unpack_zone_keys(zs.keys, digits))))
+	for v in zs.names:
+		df[v + '_mgc'] = zs.sum[v] * px_ha
+	return df
+
+# ---------------------------------------------------------------------------------------------
+# Add class names
+# ---------------------------------------------------------------------------------------------
+
+def add_class_names(df_sum, df_in, add_missing = True):
+	df_codes = df_in[df_in['pixel_values'] == 'codes']
+	for zone_var, code_csv, code_col, name_col in zip(df_codes['variable'], df_codes['code_file'], df_codes['code_col'], df_codes['name_col']):
+		df_zones = pd.read_csv(code_csv)[[code_col, name_col]]
+		df_zones[code_col] = df_zones[code_col].astype(np.float64)
+		# outer merge, as R's merge(..., all = T): codes without any pixels get a row too
+		df_sum = pd.merge(df_zones, df_sum, left_on = code_col, right_on = zone_var, how = 'outer' if add_missing else 'right')
+		if zone_var != code_col:
+			df_sum[code_col] = df_sum[code_col].fillna(df_sum[zone_var])
+			df_sum = df_sum.drop(columns = zone_var)
+		df_sum = df_sum.sort_values(code_col, na_position = 'last', kind = 'stable').reset_index(drop = True)
+	return df_sum
+
+# ---------------------------------------------------------------------------------------------
+# Write table to CSV file
+# ---------------------------------------------------------------------------------------------
+
+def write_table(df_sum, df_in, csv_out):
+
+	# for zones added that do not have any biomass, change their biomass value from NA to 0 Mg
+	mgc_cols = [c for c in df_sum.columns if c.endswith('_mgc')]
+	df_sum[mgc_cols] = df_sum[mgc_cols].fillna(0)
+
+	# zone codes are integers (NA = nodata)
+	df_codes = df_in[df_in['pixel_values'] == 'codes']
+	code_cols = list(df_codes['code_col']) + [v for v in df_in['variable'][df_in['zonal'] == 1] if v in df_sum.columns]
+	for c in code_cols: df_sum[c] = df_sum[c].astype('Int64')
+
+	print('Writing {} ...'.format(csv_out), flush = True)
+	df_sum.to_csv(csv_out, na_rep = 'NA', index = False)
+
+def main():
+	args = argparse_init().parse_args()
+
+	if (args.reduce or args.nodes > 1) and (args.partial_dir == None):
+		sys.exit('Error: --reduce and --nodes require --partial_dir')
+	if sum(d != None for d in [args.cache_dir, args.partial_dir, args.index_dir]) > 1:
+		sys.exit('Error: only one of --cache_dir, --partial_dir and --index_dir can be used')
+	if (args.country != None) and (args.index_dir == None):
+		sys.exit('Error: --country requires --index_dir')
+	print('Input: {}'.format(args.csv_in), flush = True)
+	if not os.path.exists(args.csv_out):
+		print('Output: {}'.format(args.csv_out), flush = True)
+	elif args.overwrite:
+		print('Output: {} will be overwritten.'.format(args.csv_out), flush = True)
+	else:
+		sys.exit('Error: output CSV file exists. Must set --overwrite flag to overwrite {}'.format(args.csv_out))
+
+	df_in = pd.read_csv(args.csv_in)
+	check_inputs(df_in, args.csv_in)
+
+	# zonal and biomass density variables, and their rasters
+	zone_files = collections.OrderedDict((v, f) for v, f, z in zip(df_in['variable'], df_in['file'], df_in['zonal']) if z == 1)
+	bio_files = collections.OrderedDict((v, f) for v, f, z in zip(df_in['variable'], df_in['file'], df_in['zonal']) if z == 0)
+
+	# pixel area to convert units from Mg/ha to Mg
+	px_ha = get_cell_area_ha(next(iter(zone_files.values())))
+
+	if args.reduce:
+		res = reduce_zonal(args.partial_dir, msg = True)
+	elif args.index_dir != None:
+		if not zone_index_fresh(args.index_dir, zone_files):
+			print('Building zone index {} ...'.format(args.index_dir), flush = True)
+			build_zone_index(zone_files, args.index_dir, group = 'gadm' if 'gadm' in zone_files else None, workers = args.workers, msg = True)
+		print('Processing {} raster layers using {} CPU(s) and zone index {} ...'.format(len(bio_files), args.workers, args.index_dir), flush = True)
+		res = zonal_from_index(args.index_dir, bio_files, code = args.country, workers = args.workers, msg = True)
+	elif args.cache_dir != None:
+		print('Processing {} raster layers using {} CPU(s) and cache {} ...'.format(len(df_in.index), args.workers, args.cache_dir), flush = True)
+		res = run_zonal_cached(zone_files, bio_files, args.cache_dir, workers = args.workers, msg = True)
+	else:
+		print('Processing {} raster layers using {} CPU(s) ...'.format(len(df_in.index), args.workers), flush = True)
+		res = run_zonal(zone_files, bio_files, workers = args.workers, partial_dir = args.partial_dir, node = args.node, nodes = args.nodes, msg = True)
+		if (args.partial_dir != None) and (args.nodes > 1): return
+		if args.partial_dir != None: res = reduce_zonal(args.partial_dir, msg = True)
+	if res == None: sys.exit(1)
+	zs, digits = res
+	df_sum = summary_table(zs, list(zone_files), digits, px_ha)
+
+	print('Adding class names ...', flush = True)
+	df_sum = add_class_names(df_sum, df_in, add_missing = args.country == None)
+
+	write_table(df_sum, df_in, args.csv_out)
+
+if __name__ == '__main__':
+	main()